@@ -0,0 +1,135 @@
+"""
+Сравнение построчного и столбцового построения отчета за год.
+
+Создает временную базу с пользователем, у которого за текущий год
+--transactions транзакций, и замеряет подготовку данных отчета (без отрисовки
+графиков и отправки сообщений, которые одинаковы в обоих вариантах):
+
+- построчно, как generate_report работал раньше: три get_transactions,
+  два get_categories_summary, sum() по генераторам, strptime/strftime и += на строку;
+- через ReportData: один get_transactions и векторные вычисления numpy.
+
+Пример:
+    python benchmark.py --transactions 20000 --repeat 20
+"""
+import os
+import sys
+import random
+import argparse
+import tempfile
+import time
+from datetime import datetime, timedelta
+
+# Импорт main сразу открывает базу DB_PATH: направляем ее во временный каталог,
+# чтобы замер не создавал и не мигрировал finance_bot.db в текущем каталоге
+IMPORT_DB_DIR = tempfile.TemporaryDirectory()
+os.environ['DB_PATH'] = os.path.join(IMPORT_DB_DIR.name, 'finance_bot.db')
+
+import main
+
+
+CATEGORIES = ['Еда', 'Кафе', 'Доставка', 'Транспорт', 'Коммунальные платежи', 'Табак', 'Цветы', 'Зоотовары']
+INCOME_CATEGORIES = ['Зарплата', 'Подработка', 'Подарок']
+
+
+def fill_database(db, user_id, count, seed=1):
+    """Добавляет пользователю count случайных транзакций с начала года до текущего момента."""
+    rng = random.Random(seed)
+    now = datetime.now()
+    year_start = now.replace(month=1, day=1, hour=0, minute=0, second=0, microsecond=0)
+    span = int((now - year_start).total_seconds())
+
+    rows = []
+    for _ in range(count):
+        date = (year_start + timedelta(seconds=rng.randrange(span))).strftime('%Y-%m-%d %H:%M:%S')
+        if rng.random() < 0.1:
+            rows.append((user_id, 'income', rng.choice(INCOME_CATEGORIES), rng.randint(1000, 50000), date, None))
+        else:
+            rows.append((user_id, 'expense', rng.choice(CATEGORIES), rng.randint(50, 5000), date, None))
+    db.add_user(user_id)
+    db.add_transactions(rows)
+
+
+def format_transactions_rows(transactions):
+    """Построчное форматирование, как было раньше: strptime, strftime и += на каждую транзакцию."""
+    result = ""
+    for tx in transactions:
+        date_obj = datetime.strptime(tx['date'], '%Y-%m-%d %H:%M:%S')
+        date_str = date_obj.strftime('%d.%m.%Y %H:%M')
+        symbol = "➖" if tx['type'] == 'expense' else "➕"
+        result += f"{date_str} {symbol} *{tx['category']}*: {tx['amount']:.2f} ₽\n"
+    return result
+
+
+def report_rows(db, user_id, start_date, end_date):
+    """Подготовка данных отчета по строкам."""
+    expenses = db.get_transactions(user_id, start_date, end_date, transaction_type='expense')
+    incomes = db.get_transactions(user_id, start_date, end_date, transaction_type='income')
+    total_expense = sum(expense['amount'] for expense in expenses)
+    total_income = sum(income['amount'] for income in incomes)
+    expense_summary = db.get_categories_summary(user_id, start_date, end_date, 'expense')
+    income_summary = db.get_categories_summary(user_id, start_date, end_date, 'income')
+    labels = [summary['category'] for summary in expense_summary + income_summary]
+    amounts = [summary['total_amount'] for summary in expense_summary + income_summary]
+    all_transactions = db.get_transactions(user_id, start_date, end_date)
+    details = format_transactions_rows(all_transactions[:15])
+    return total_expense, total_income, labels, amounts, details
+
+
+def report_columns(db, user_id, start_date, end_date):
+    """Подготовка данных отчета по столбцам через ReportData."""
+    all_transactions = db.get_transactions(user_id, start_date, end_date)
+    report = main.ReportData(all_transactions)
+    total_expense = report.total('expense')
+    total_income = report.total('income')
+    expense_labels, expense_amounts, _ = report.category_totals('expense')
+    income_labels, income_amounts, _ = report.category_totals('income')
+    report.daily_totals('expense')
+    details = main.format_transactions(all_transactions[:15])
+    return total_expense, total_income, expense_labels + income_labels, expense_amounts + income_amounts, details
+
+
+def measure(function, repeat, *args):
+    """Возвращает лучшее время выполнения function(*args) из repeat попыток и ее результат."""
+    best = float('inf')
+    result = None
+    for _ in range(repeat):
+        started = time.perf_counter()
+        result = function(*args)
+        best = min(best, time.perf_counter() - started)
+    return best, result
+
+
+def main_cli():
+    parser = argparse.ArgumentParser(description='Сравнение построчного и столбцового отчета')
+    parser.add_argument('--transactions', type=int, default=12000, help='транзакций у пользователя за год')
+    parser.add_argument('--repeat', type=int, default=10, help='количество повторов каждого замера')
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        db = main.DatabaseManager(os.path.join(tmp_dir, 'benchmark.db'))
+        user_id = 1
+        fill_database(db, user_id, args.transactions)
+        start_date, end_date = main.get_report_period('year')
+
+        rows_time, rows_result = measure(report_rows, args.repeat, db, user_id, start_date, end_date)
+        columns_time, columns_result = measure(report_columns, args.repeat, db, user_id, start_date, end_date)
+
+        # Полная детализация за год показывает разницу именно в форматировании текста
+        all_transactions = db.get_transactions(user_id, start_date, end_date)
+        format_rows_time, _ = measure(format_transactions_rows, args.repeat, all_transactions)
+        format_join_time, _ = measure(main.format_transactions, args.repeat, all_transactions)
+
+    assert abs(rows_result[0] - columns_result[0]) < 1e-6 and abs(rows_result[1] - columns_result[1]) < 1e-6
+    assert rows_result[4] == columns_result[4]
+
+    print(f"Транзакций за год: {args.transactions}, лучшее из {args.repeat} повторов")
+    print(f"Отчет по строкам:      {rows_time * 1000:8.1f} мс")
+    print(f"Отчет по столбцам:     {columns_time * 1000:8.1f} мс  (x{rows_time / columns_time:.1f})")
+    print(f"Детализация, += :      {format_rows_time * 1000:8.1f} мс")
+    print(f"Детализация, join:     {format_join_time * 1000:8.1f} мс  (x{format_rows_time / format_join_time:.1f})")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main_cli())
@@ -0,0 +1,153 @@
+"""
+Проверка сохранности транзакций при групповой записи после падения процесса.
+
+Запускает писателя с групповой записью в отдельном процессе: несколько потоков
+сохраняют многострочные сообщения через main.save_transactions и после ее
+возврата (то есть после подтверждения) дописывают номер сообщения в журнал.
+Через случайное время процесс убивается без завершения (SIGKILL), база
+открывается заново и проверяется, что:
+
+- каждое подтвержденное сообщение сохранено целиком;
+- ни одно сообщение не сохранено частично.
+
+Пример:
+    python crashtest.py --rounds 5 --shards 2
+"""
+import os
+import sys
+import random
+import sqlite3
+import argparse
+import tempfile
+import threading
+import subprocess
+import time
+
+# Импорт main сразу открывает базу DB_PATH: направляем ее во временный каталог,
+# чтобы проверка не создавала и не мигрировала finance_bot.db в текущем каталоге
+IMPORT_DB_DIR = tempfile.TemporaryDirectory()
+os.environ['DB_PATH'] = os.path.join(IMPORT_DB_DIR.name, 'finance_bot.db')
+
+import main
+
+
+def message_note(message_id):
+    """Заметка, по которой строки сообщения находятся после перезапуска."""
+    return f"crash-{message_id}"
+
+
+# Процесс-писатель
+def writer(db_path, shards, confirmed_path, users, threads, lines):
+    """Бесконечно сохраняет сообщения через групповую запись и журналирует подтвержденные."""
+    main.db = main.DatabaseManager(db_path, shards)
+    if main.ingestor is not None:
+        main.ingestor.stop()
+    main.ingestor = main.TransactionIngestor(main.db, main.GROUP_COMMIT_INTERVAL_MS / 1000, main.GROUP_COMMIT_BATCH_SIZE)
+
+    for user_id in range(1, users + 1):
+        main.db.add_user(user_id)
+
+    journal = os.open(confirmed_path, os.O_WRONLY | os.O_APPEND | os.O_CREAT)
+    counter = iter(range(1, sys.maxsize))
+    counter_lock = threading.Lock()
+
+    def work(seed):
+        rng = random.Random(seed)
+        while True:
+            with counter_lock:
+                message_id = next(counter)
+            user_id = rng.randint(1, users)
+            note = message_note(message_id)
+            transactions = [('expense', 'Еда', rng.randint(1, 1000), note) for _ in range(lines)]
+            main.save_transactions(user_id, transactions)
+            # Запись в файл переживает SIGKILL: данные уже в кэше ОС
+            os.write(journal, f"{message_id}\n".encode())
+
+    workers = [threading.Thread(target=work, args=(seed,), daemon=True) for seed in range(threads)]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+
+
+# Проверка после падения
+def check(db_path, shards, confirmed_path, lines):
+    """Открывает базу заново и сверяет ее с журналом подтверждений. Возвращает список ошибок."""
+    db = main.DatabaseManager(db_path, shards)
+
+    counts = {}
+    for index in range(shards):
+        conn = sqlite3.connect(db.shard_path(index))
+        try:
+            for note, count in conn.execute(
+                    "SELECT note, COUNT(*) FROM transactions WHERE note LIKE 'crash-%' GROUP BY note"):
+                counts[note] = count
+        finally:
+            conn.close()
+
+    with open(confirmed_path) as f:
+        confirmed = [int(line) for line in f.read().split()]
+
+    errors = []
+    for message_id in confirmed:
+        count = counts.get(message_note(message_id), 0)
+        if count != lines:
+            errors.append(f"подтвержденное сообщение {message_id}: {count} строк из {lines}")
+    for note, count in counts.items():
+        if count != lines:
+            errors.append(f"сообщение {note} сохранено частично: {count} строк из {lines}")
+    return errors, len(confirmed), len(counts)
+
+
+def run_round(tmp_dir, round_number, args, rng):
+    """Один цикл: запуск писателя, SIGKILL, проверка."""
+    db_path = os.path.join(tmp_dir, f'crash_{round_number}.db')
+    confirmed_path = os.path.join(tmp_dir, f'confirmed_{round_number}.txt')
+    open(confirmed_path, 'w').close()
+
+    process = subprocess.Popen([
+        sys.executable, os.path.abspath(__file__), '--writer', db_path, confirmed_path,
+        '--shards', str(args.shards), '--users', str(args.users),
+        '--threads', str(args.threads), '--lines', str(args.lines),
+    ])
+    # Отсчет до падения начинается с первого подтверждения, чтобы цикл не закончился
+    # раньше, чем писатель успеет импортировать main и открыть базу
+    while os.path.getsize(confirmed_path) == 0 and process.poll() is None:
+        time.sleep(0.05)
+    time.sleep(rng.uniform(args.min_delay, args.max_delay))
+    process.kill()
+    process.wait()
+
+    errors, confirmed, stored = check(db_path, args.shards, confirmed_path, args.lines)
+    print(f"Цикл {round_number}: подтверждено {confirmed}, в базе {stored} сообщений, ошибок {len(errors)}")
+    for error in errors[:10]:
+        print(f"  {error}")
+    return not errors
+
+
+def main_cli():
+    parser = argparse.ArgumentParser(description='Проверка сохранности транзакций после падения')
+    parser.add_argument('--rounds', type=int, default=5, help='количество циклов запуск-падение-проверка')
+    parser.add_argument('--shards', type=int, default=1, help='количество шардов базы')
+    parser.add_argument('--users', type=int, default=50, help='количество пользователей')
+    parser.add_argument('--threads', type=int, default=8, help='потоков-писателей')
+    parser.add_argument('--lines', type=int, default=5, help='строк в одном сообщении')
+    parser.add_argument('--min-delay', type=float, default=1.0, help='минимальное время до падения, с')
+    parser.add_argument('--max-delay', type=float, default=3.0, help='максимальное время до падения, с')
+    parser.add_argument('--seed', type=int, default=None, help='seed для времени падения')
+    parser.add_argument('--writer', nargs=2, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.writer:
+        writer(args.writer[0], args.shards, args.writer[1], args.users, args.threads, args.lines)
+        return 0
+
+    rng = random.Random(args.seed)
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        results = [run_round(tmp_dir, round_number, args, rng) for round_number in range(1, args.rounds + 1)]
+
+    return 0 if all(results) else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main_cli())
@@ -0,0 +1,379 @@
+"""
+Нагрузочный тест бота на реальных обработчиках из main.py.
+
+Вместо Telegram API подставляется фейковый транспорт, а обновления (сообщения,
+многострочные вставки, нажатия кнопок отчетов, добавление категорий)
+подаются в bot.process_new_updates с заданной частотой. В конце выводятся
+пропускная способность, перцентили задержки и время ожидания блокировок SQLite.
+
+Примеры:
+    python loadtest.py --rate 50 --duration 30 --users 200
+    python loadtest.py --rate 50 --duration 30 --record updates.jsonl
+    python loadtest.py --rate 100 --replay updates.jsonl
+"""
+import os
+import sys
+import json
+import time
+import random
+import sqlite3
+import argparse
+import tempfile
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from telebot import apihelper, types
+
+# Импорт main сразу открывает базу DB_PATH: направляем ее во временный каталог,
+# чтобы тест не создавал и не мигрировал finance_bot.db в текущем каталоге
+IMPORT_DB_DIR = tempfile.TemporaryDirectory()
+os.environ['DB_PATH'] = os.path.join(IMPORT_DB_DIR.name, 'finance_bot.db')
+
+import main
+
+
+# Доли разных видов обновлений в синтетическом потоке
+UPDATE_MIX = [
+    ('transaction', 50),
+    ('multiline', 15),
+    ('report', 15),
+    ('trends', 5),
+    ('view_categories', 5),
+    ('add_category', 5),
+    ('help', 5),
+]
+
+EXPENSE_LINES = ['кафе 500', 'такси 300р', 'продукты 1250', 'доставка 600', 'кофе 250', 'метро 60', 'корм 900']
+INCOME_LINES = ['+зарплата 50000', '+подработка 5000р', '+подарок 3000']
+REPORT_PERIODS = ['day', 'week', 'month', 'year']
+
+
+# Класс фейкового транспорта Telegram
+class FakeTelegram:
+    """Отвечает на запросы к Bot API вместо api.telegram.org и считает вызовы."""
+
+    class Response:
+        status_code = 200
+
+        def __init__(self, result):
+            self.result = result
+            self.text = json.dumps(self.json())
+
+        def json(self):
+            return {'ok': True, 'result': self.result}
+
+    def __init__(self, api_latency=0.0):
+        self.api_latency = api_latency
+        self.calls = {}
+        self.lock = threading.Lock()
+        self.message_id = 0
+
+    def __call__(self, method, url, params=None, files=None, **kwargs):
+        method_name = url.rsplit('/', 1)[-1]
+        with self.lock:
+            self.calls[method_name] = self.calls.get(method_name, 0) + 1
+            self.message_id += 1
+            message_id = self.message_id
+
+        if self.api_latency:
+            time.sleep(self.api_latency)
+
+        if method_name == 'answerCallbackQuery':
+            return self.Response(True)
+
+        chat_id = int((params or {}).get('chat_id', 0))
+        return self.Response({
+            'message_id': message_id,
+            'date': int(time.time()),
+            'chat': {'id': chat_id, 'type': 'private'},
+        })
+
+
+# Класс соединения, измеряющий время ожидания в SQLite
+class TimedConnection(sqlite3.Connection):
+    """
+    Соединение, которое суммирует время записи и коммитов.
+
+    Сама запись в SQLite занимает микросекунды, поэтому время выполнения
+    INSERT/UPDATE/DELETE почти целиком состоит из ожидания блокировки
+    на запись. Коммит включает fsync и ожидание завершения читателей.
+    """
+    stats = None
+
+    def cursor(self, factory=None):
+        return super().cursor(factory or TimedCursor)
+
+    def execute(self, sql, parameters=()):
+        return self.cursor().execute(sql, parameters)
+
+    def executemany(self, sql, seq_of_parameters):
+        return self.cursor().executemany(sql, seq_of_parameters)
+
+    def commit(self):
+        started = time.perf_counter()
+        try:
+            return super().commit()
+        finally:
+            self.stats.add('commit', time.perf_counter() - started)
+
+
+class TimedCursor(sqlite3.Cursor):
+    """Курсор, измеряющий время выполнения пишущих запросов."""
+
+    WRITE_STATEMENTS = ('INSERT', 'UPDATE', 'DELETE', 'REPLACE')
+
+    def execute(self, sql, parameters=()):
+        if not sql.lstrip().upper().startswith(self.WRITE_STATEMENTS):
+            return super().execute(sql, parameters)
+        started = time.perf_counter()
+        try:
+            return super().execute(sql, parameters)
+        finally:
+            self.connection.stats.add('lock_wait', time.perf_counter() - started)
+
+    def executemany(self, sql, seq_of_parameters):
+        started = time.perf_counter()
+        try:
+            return super().executemany(sql, seq_of_parameters)
+        finally:
+            self.connection.stats.add('lock_wait', time.perf_counter() - started)
+
+
+# Класс для сбора статистики
+class Stats:
+    """Потокобезопасные счетчики задержек и времени в базе."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.latencies = []
+        self.kinds = {}
+        self.errors = 0
+        self.db_time = {'lock_wait': 0.0, 'commit': 0.0}
+        self.db_max = {'lock_wait': 0.0, 'commit': 0.0}
+
+    def add(self, key, seconds):
+        with self.lock:
+            self.db_time[key] += seconds
+            self.db_max[key] = max(self.db_max[key], seconds)
+
+    def record(self, kind, latency, ok):
+        with self.lock:
+            self.latencies.append(latency)
+            self.kinds[kind] = self.kinds.get(kind, 0) + 1
+            if not ok:
+                self.errors += 1
+
+
+def percentile(sorted_values, fraction):
+    """Возвращает перцентиль из отсортированного списка."""
+    if not sorted_values:
+        return 0.0
+    index = min(len(sorted_values) - 1, int(round(fraction * (len(sorted_values) - 1))))
+    return sorted_values[index]
+
+
+# Функции для построения синтетических обновлений
+def make_message(update_id, user_id, text):
+    """Создает обновление с текстовым сообщением."""
+    message = {
+        'message_id': update_id,
+        'date': int(time.time()),
+        'chat': {'id': user_id, 'type': 'private'},
+        'from': {'id': user_id, 'is_bot': False, 'first_name': f'user{user_id}'},
+        'text': text,
+    }
+    if text.startswith('/'):
+        command = text.split()[0]
+        message['entities'] = [{'type': 'bot_command', 'offset': 0, 'length': len(command)}]
+    return {'update_id': update_id, 'message': message}
+
+
+def make_callback(update_id, user_id, data):
+    """Создает обновление с нажатием инлайн-кнопки."""
+    return {
+        'update_id': update_id,
+        'callback_query': {
+            'id': str(update_id),
+            'from': {'id': user_id, 'is_bot': False, 'first_name': f'user{user_id}'},
+            'chat_instance': str(user_id),
+            'data': data,
+            'message': {
+                'message_id': update_id,
+                'date': int(time.time()),
+                'chat': {'id': user_id, 'type': 'private'},
+                'text': '',
+            },
+        },
+    }
+
+
+def generate_updates(count, users, seed=None):
+    """Генерирует count обновлений в пропорциях UPDATE_MIX для пользователей 1..users."""
+    rng = random.Random(seed)
+    kinds = [kind for kind, _ in UPDATE_MIX]
+    weights = [weight for _, weight in UPDATE_MIX]
+    updates = []
+    update_id = 0
+
+    while len(updates) < count:
+        update_id += 1
+        user_id = rng.randint(1, users)
+        kind = rng.choices(kinds, weights)[0]
+
+        if kind == 'transaction':
+            line = rng.choice(INCOME_LINES if rng.random() < 0.1 else EXPENSE_LINES)
+            updates.append((kind, make_message(update_id, user_id, line)))
+        elif kind == 'multiline':
+            lines = [rng.choice(EXPENSE_LINES + INCOME_LINES) for _ in range(rng.randint(2, 10))]
+            updates.append((kind, make_message(update_id, user_id, '\n'.join(lines))))
+        elif kind == 'report':
+            period = rng.choice(REPORT_PERIODS)
+            updates.append((kind, make_callback(update_id, user_id, f'report_{period}')))
+        elif kind == 'trends':
+            updates.append((kind, make_message(update_id, user_id, '/trends')))
+        elif kind == 'view_categories':
+            updates.append((kind, make_callback(update_id, user_id, 'view_expense_categories')))
+        elif kind == 'add_category':
+            # Нажатие кнопки и следующий шаг с описанием категории
+            updates.append((kind, make_callback(update_id, user_id, 'add_category')))
+            update_id += 1
+            text = f'expense Тест{update_id} тест{update_id},проверка'
+            updates.append((kind, make_message(update_id, user_id, text)))
+        else:
+            updates.append((kind, make_message(update_id, user_id, '/help')))
+
+    return updates[:count]
+
+
+def save_updates(path, updates):
+    """Сохраняет поток обновлений в JSONL для повторного воспроизведения."""
+    with open(path, 'w', encoding='utf-8') as f:
+        for kind, update in updates:
+            f.write(json.dumps({'kind': kind, 'update': update}, ensure_ascii=False) + '\n')
+
+
+def load_updates(path):
+    """Загружает поток обновлений из JSONL (одно обновление Bot API на строку)."""
+    updates = []
+    with open(path, encoding='utf-8') as f:
+        for line in f:
+            if line.strip():
+                record = json.loads(line)
+                updates.append((record.get('kind', 'recorded'), record['update']))
+    return updates
+
+
+# Подготовка бота к тесту
+def setup_bot(db_path, shards, users, api_latency, rate_limit=False):
+    """Подменяет транспорт и базу в main и создает тестовых пользователей."""
+    stats = Stats()
+    transport = FakeTelegram(api_latency)
+    apihelper.CUSTOM_REQUEST_SENDER = transport
+
+    main.bot.token = main.bot.token or 'loadtest:TOKEN'
+    # Обработчики выполняются в потоках теста, чтобы измерять задержку каждого обновления
+    main.bot.threaded = False
+    # По умолчанию измеряем сами обработчики, без ограничения частоты запросов
+    if not rate_limit:
+        main.rate_limiter.capacity = 0
+
+    main.db = main.DatabaseManager(db_path, shards)
+    for user_id in range(1, users + 1):
+        main.db.add_user(user_id)
+
+    TimedConnection.stats = stats
+    main.db.connection_factory = TimedConnection
+
+    if main.ingestor is not None:
+        main.ingestor.stop()
+        main.ingestor = main.TransactionIngestor(main.db, main.ingestor.flush_interval, main.ingestor.batch_size)
+
+    return stats, transport
+
+
+def run(updates, rate, workers, stats):
+    """Подает обновления с частотой rate в секунду и ждет их обработки."""
+    def process(kind, update, scheduled):
+        ok = True
+        try:
+            main.bot.process_new_updates([types.Update.de_json(update)])
+        except Exception as e:
+            ok = False
+            main.logger.error(f"Ошибка при обработке обновления {update['update_id']}: {e}")
+        stats.record(kind, time.perf_counter() - scheduled, ok)
+
+    interval = 1.0 / rate
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        for i, (kind, update) in enumerate(updates):
+            # Открытая модель нагрузки: задержка считается от запланированного времени,
+            # поэтому в нее входит и время ожидания свободного потока
+            scheduled = started + i * interval
+            delay = scheduled - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+            executor.submit(process, kind, update, scheduled)
+    return time.perf_counter() - started
+
+
+def print_report(stats, transport, elapsed, rate):
+    """Выводит итоги теста."""
+    latencies = sorted(stats.latencies)
+    count = len(latencies)
+
+    print(f"Обновлений: {count}, ошибок: {stats.errors}, время: {elapsed:.2f} с")
+    print(f"Целевая частота: {rate:.1f}/с, фактическая пропускная способность: {count / elapsed:.1f}/с")
+    print("Задержка (мс): p50 {:.1f}, p95 {:.1f}, p99 {:.1f}, max {:.1f}".format(
+        percentile(latencies, 0.50) * 1000,
+        percentile(latencies, 0.95) * 1000,
+        percentile(latencies, 0.99) * 1000,
+        (latencies[-1] if latencies else 0.0) * 1000,
+    ))
+    print("SQLite: ожидание блокировки на запись {:.2f} с (max {:.1f} мс), коммиты {:.2f} с (max {:.1f} мс)".format(
+        stats.db_time['lock_wait'], stats.db_max['lock_wait'] * 1000,
+        stats.db_time['commit'], stats.db_max['commit'] * 1000,
+    ))
+    print("Виды обновлений: " + ", ".join(f"{kind} {n}" for kind, n in sorted(stats.kinds.items())))
+    print("Вызовы Bot API: " + ", ".join(f"{method} {n}" for method, n in sorted(transport.calls.items())))
+
+
+def main_cli():
+    parser = argparse.ArgumentParser(description='Нагрузочный тест обработчиков бота')
+    parser.add_argument('--rate', type=float, default=20.0, help='обновлений в секунду')
+    parser.add_argument('--duration', type=float, default=10.0, help='длительность синтетического потока, с')
+    parser.add_argument('--users', type=int, default=100, help='количество пользователей')
+    parser.add_argument('--workers', type=int, default=8, help='количество потоков обработки')
+    parser.add_argument('--shards', type=int, default=1, help='количество шардов базы')
+    parser.add_argument('--api-latency-ms', type=float, default=0.0, help='задержка фейкового Bot API, мс')
+    parser.add_argument('--rate-limit', action='store_true', help='включить ограничение частоты запросов')
+    parser.add_argument('--db', help='файл базы (по умолчанию временный)')
+    parser.add_argument('--record', help='сохранить сгенерированный поток в JSONL')
+    parser.add_argument('--replay', help='воспроизвести поток из JSONL')
+    parser.add_argument('--seed', type=int, default=None, help='seed генератора обновлений')
+    args = parser.parse_args()
+
+    if args.replay:
+        updates = load_updates(args.replay)
+        users = max(
+            (update.get('message') or update.get('callback_query'))['from']['id']
+            for _, update in updates
+        )
+    else:
+        updates = generate_updates(int(args.rate * args.duration), args.users, args.seed)
+        users = args.users
+    if args.record:
+        save_updates(args.record, updates)
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        db_path = args.db or os.path.join(tmp_dir, 'loadtest.db')
+        stats, transport = setup_bot(db_path, args.shards, users, args.api_latency_ms / 1000, args.rate_limit)
+        elapsed = run(updates, args.rate, args.workers, stats)
+        if main.ingestor is not None:
+            main.ingestor.stop()
+        print_report(stats, transport, elapsed, args.rate)
+
+    return 0 if stats.errors == 0 else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main_cli())
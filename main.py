@@ -7,12 +7,21 @@ import re
 import datetime
 import sqlite3
 import telebot
-import matplotlib.pyplot as plt
 import matplotlib
+from matplotlib.figure import Figure
+import numpy as np
 from dotenv import load_dotenv
 from telebot import types
+from telebot.handler_backends import BaseMiddleware, CancelUpdate
 from datetime import datetime, timedelta
 import io
+import sys
+import json
+import zlib
+import queue
+from collections import OrderedDict
+from concurrent.futures import Future
+from itertools import groupby
 
 # Настройка Matplotlib для поддержки кириллицы
 matplotlib.use('Agg')
@@ -24,6 +33,53 @@ load_dotenv()
 # Получение токена из переменной окружения
 BOT_TOKEN = os.getenv('BOT_TOKEN')
 
+# Файл базы данных (нулевой шард; остальные шарды лежат рядом с ним)
+DB_PATH = os.getenv('DB_PATH', 'finance_bot.db')
+
+# Количество файлов-шардов базы данных (1 - одна база, как раньше)
+DB_SHARDS = int(os.getenv('DB_SHARDS', '1'))
+
+# Транзакции старше этого количества дней (с округлением до начала года) переносятся в архив
+ARCHIVE_HORIZON_DAYS = int(os.getenv('ARCHIVE_HORIZON_DAYS', '365'))
+
+# Групповая запись транзакций: один коммит на несколько сообщений
+GROUP_COMMIT = os.getenv('GROUP_COMMIT', '0') == '1'
+GROUP_COMMIT_INTERVAL_MS = int(os.getenv('GROUP_COMMIT_INTERVAL_MS', '5'))
+GROUP_COMMIT_BATCH_SIZE = int(os.getenv('GROUP_COMMIT_BATCH_SIZE', '100'))
+
+# Кэш недавних транзакций: максимум записей в памяти (0 - кэш выключен)
+RECENT_CACHE_MAX_RECORDS = int(os.getenv('RECENT_CACHE_MAX_RECORDS', '100000'))
+
+# Отчет о динамике расходов: месяцев по умолчанию, максимум и число отдельных категорий на графике
+TRENDS_DEFAULT_MONTHS = 6
+TRENDS_MAX_MONTHS = 24
+TRENDS_TOP_CATEGORIES = 7
+
+# Незавершенные диалоги (например, ввод новой категории): время жизни и максимум на шард
+CONVERSATION_TTL_SECONDS = int(os.getenv('CONVERSATION_TTL_SECONDS', '600'))
+CONVERSATION_MAX_PENDING = int(os.getenv('CONVERSATION_MAX_PENDING', '10000'))
+
+# Ограничение частоты запросов: емкость корзины токенов, пополнение в секунду (0 - без ограничений)
+RATE_LIMIT_CAPACITY = float(os.getenv('RATE_LIMIT_CAPACITY', '60'))
+RATE_LIMIT_REFILL_PER_SEC = float(os.getenv('RATE_LIMIT_REFILL_PER_SEC', '1'))
+
+# Стоимость операций в токенах: строка транзакции, простая команда, отчет с графиками
+OPERATION_COSTS = {
+    'line': 1,
+    'command': 1,
+    'report': 10,
+    'search': 3,
+}
+
+# Количество результатов поиска на одной странице
+SEARCH_PAGE_SIZE = 10
+
+# Максимум строк с транзакциями в одном сообщении
+MAX_LINES_PER_MESSAGE = int(os.getenv('MAX_LINES_PER_MESSAGE', '50'))
+
+# Количество потоков обработки сообщений
+BOT_THREADS = int(os.getenv('BOT_THREADS', '2'))
+
 # Настройка логирования
 logging.basicConfig(
     level=logging.INFO,
@@ -32,65 +88,483 @@ logging.basicConfig(
 logger = logging.getLogger(__name__)
 
 # Инициализация бота
-bot = telebot.TeleBot(BOT_TOKEN)
+bot = telebot.TeleBot(BOT_TOKEN, num_threads=BOT_THREADS, use_class_middlewares=True)
+
+
+# Компактная запись транзакции для кэша
+class CachedTransaction:
+    """Транзакция в памяти. Поддерживает доступ tx['amount'], как sqlite3.Row."""
+    __slots__ = ('id', 'user_id', 'type', 'category', 'amount', 'date', 'note')
+
+    def __init__(self, id, user_id, type, category, amount, date, note=None):
+        self.id = id
+        self.user_id = user_id
+        self.type = type
+        self.category = category
+        self.amount = amount
+        self.date = date
+        self.note = note
+
+    def __getitem__(self, key):
+        return getattr(self, key)
+
+
+# Кэш транзакций пользователей за текущую неделю
+class RecentTransactionsCache:
+    """
+    Кэш транзакций с начала текущей недели для отчетов за день и неделю.
+
+    Пользователи вытесняются по LRU, когда общее количество записей
+    превышает max_records. Новые транзакции дописываются в кэш после
+    коммита (write-through). Пока данные пользователя загружаются из базы,
+    новые записи копятся в pending и затем объединяются с загруженными по id,
+    поэтому транзакция, закоммиченная во время загрузки, не теряется.
+    Кэш рассчитан на то, что в базу пишет только этот процесс.
+    """
+
+    class Entry:
+        __slots__ = ('loaded_from', 'records', 'pending')
+
+        def __init__(self, loaded_from):
+            self.loaded_from = loaded_from
+            self.records = None
+            self.pending = []
+
+    def __init__(self, max_records=RECENT_CACHE_MAX_RECORDS):
+        self.max_records = max_records
+        self.users = OrderedDict()
+        self.size = 0
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def window_start():
+        """Начало окна кэша - понедельник текущей недели."""
+        now = datetime.now()
+        start = (now - timedelta(days=now.weekday())).replace(hour=0, minute=0, second=0, microsecond=0)
+        return start.strftime('%Y-%m-%d %H:%M:%S')
+
+    def get(self, user_id, start_date):
+        """Возвращает записи пользователя, если кэш покрывает период с start_date, иначе None."""
+        window_start = self.window_start()
+        with self.lock:
+            entry = self.users.get(user_id)
+            if entry is None or entry.records is None or start_date < entry.loaded_from:
+                return None
+            if entry.loaded_from < window_start:
+                # Началась новая неделя - прошлая больше не нужна
+                kept = [record for record in entry.records if record.date >= window_start]
+                self.size -= len(entry.records) - len(kept)
+                entry.records = kept
+                entry.loaded_from = window_start
+            self.users.move_to_end(user_id)
+            return list(entry.records)
+
+    def begin_load(self, user_id, loaded_from):
+        """Отмечает начало загрузки пользователя из базы. Возвращает False, если кэш выключен."""
+        if self.max_records <= 0:
+            return False
+        with self.lock:
+            entry = self.users.get(user_id)
+            if entry is not None and entry.records is not None:
+                # Окно сдвинулось на новую неделю - загружаем заново
+                self.size -= len(entry.records)
+            if entry is None or entry.records is not None:
+                self.users[user_id] = self.Entry(loaded_from)
+            return True
+
+    def finish_load(self, user_id, records):
+        """Сохраняет загруженные записи, объединяя их с записями, добавленными во время загрузки."""
+        with self.lock:
+            entry = self.users.get(user_id)
+            if entry is None or entry.records is not None:
+                return
+            ids = {record.id for record in records}
+            merged = records + [record for record in entry.pending if record.id not in ids]
+            merged.sort(key=lambda record: record.date)
+            entry.records = merged
+            entry.pending = []
+            self.size += len(merged)
+            self.users.move_to_end(user_id)
+            self.evict()
+
+    def append(self, user_id, records):
+        """Дописывает новые транзакции пользователя, если он есть в кэше."""
+        with self.lock:
+            entry = self.users.get(user_id)
+            if entry is None:
+                return
+            records = [record for record in records if record.date >= entry.loaded_from]
+            if entry.records is None:
+                entry.pending.extend(records)
+                return
+            for record in records:
+                if entry.records and record.date < entry.records[-1].date:
+                    entry.records.append(record)
+                    entry.records.sort(key=lambda item: item.date)
+                else:
+                    entry.records.append(record)
+            self.size += len(records)
+            self.evict()
+
+    def evict(self):
+        """Вытесняет давно неиспользованных пользователей, пока кэш больше лимита."""
+        while self.size > self.max_records and self.users:
+            _, entry = self.users.popitem(last=False)
+            if entry.records is not None:
+                self.size -= len(entry.records)
 
 
 # Класс для работы с базой данных
 class DatabaseManager:
-    def __init__(self, db_name='finance_bot.db'):
+    # Таблицы, id которых виден пользователю (кнопки delete_category_<id>) и сохраняется при перераспределении
+    STABLE_ID_TABLES = ('categories',)
+    # Размер диапазона id категорий, который получает каждый шард
+    CATEGORY_ID_RANGE = 10 ** 9
+
+    def __init__(self, db_name='finance_bot.db', shards=1):
         self.db_name = db_name
+        self.shard_count = shards
+        self.recent_cache = RecentTransactionsCache()
+        # Класс соединения sqlite3 (нагрузочный тест подставляет свой, чтобы измерять ожидание блокировок)
+        self.connection_factory = sqlite3.Connection
         self.init_db()
-
-    def get_connection(self):
-        """Создает соединение с базой данных."""
-        conn = sqlite3.connect(self.db_name)
+        self.check_shard_count()
+        # Граница архива: транзакции с датой раньше нее лежат в archive_chunks
+        self.archived_before = self.get_meta('archived_before')
+
+    def shard_index(self, user_id):
+        """Возвращает номер шарда для пользователя (стабильный хеш от user_id)."""
+        if self.shard_count == 1:
+            return 0
+        return zlib.crc32(str(user_id).encode()) % self.shard_count
+
+    def shard_path(self, index):
+        """Возвращает путь к файлу шарда. Нулевой шард - это исходный файл базы."""
+        if index == 0:
+            return self.db_name
+        base, ext = os.path.splitext(self.db_name)
+        return f"{base}_{index}{ext}"
+
+    def shard_paths(self):
+        """Возвращает пути ко всем файлам шардов."""
+        return [self.shard_path(index) for index in range(self.shard_count)]
+
+    def get_connection(self, user_id=None):
+        """Создает соединение с шардом пользователя (без user_id - с нулевым шардом)."""
+        path = self.shard_path(self.shard_index(user_id)) if user_id is not None else self.db_name
+        return self.connect(path)
+
+    def connect(self, path):
+        """Создает соединение с указанным файлом базы данных."""
+        conn = sqlite3.connect(path, factory=self.connection_factory)
         conn.row_factory = sqlite3.Row  # Для доступа к столбцам по имени
+        # Триггеры полнотекстового индекса вызывают search_terms при каждой записи транзакции
+        conn.create_function('search_terms', 2, self.search_terms, deterministic=True)
         return conn
 
     def init_db(self):
-        """Инициализирует базу данных, создавая необходимые таблицы."""
-        with self.get_connection() as conn:
-            cursor = conn.cursor()
+        """Инициализирует все шарды базы данных, создавая необходимые таблицы."""
+        for path in self.shard_paths():
+            with self.connect(path) as conn:
+                self.create_tables(conn)
+            if self.get_meta('rollups_running', path) is None:
+                self.backfill_rollups(path)
+
+    def backfill_rollups(self, path):
+        """Однократно заполняет итоги по месяцам для транзакций, записанных до их появления."""
+        with self.connect(path) as conn:
+            conn.execute('''
+            INSERT OR REPLACE INTO transaction_rollups (user_id, month, type, category, total, count)
+            SELECT user_id, strftime('%Y-%m', date), type, category, SUM(amount), COUNT(*)
+            FROM transactions
+            GROUP BY user_id, strftime('%Y-%m', date), type, category
+            ''')
+            conn.execute(
+                'INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)',
+                ('rollups_running', '1')
+            )
+            conn.commit()
+
+    def create_tables(self, conn):
+        """Создает таблицы в одном файле базы данных."""
+        cursor = conn.cursor()
 
-            # Таблица пользователей
+        # Таблица пользователей
+        cursor.execute('''
+        CREATE TABLE IF NOT EXISTS users (
+            user_id INTEGER PRIMARY KEY,
+            notifications BOOLEAN DEFAULT TRUE,
+            last_activity TEXT
+        )
+        ''')
+
+        # Таблица категорий
+        cursor.execute('''
+        CREATE TABLE IF NOT EXISTS categories (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER,
+            name TEXT,
+            type TEXT,
+            keywords TEXT,
+            FOREIGN KEY (user_id) REFERENCES users (user_id)
+        )
+        ''')
+
+        # Таблица транзакций
+        cursor.execute('''
+        CREATE TABLE IF NOT EXISTS transactions (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER,
+            type TEXT,
+            category TEXT,
+            amount REAL,
+            date TEXT,
+            note TEXT,
+            FOREIGN KEY (user_id) REFERENCES users (user_id)
+        )
+        ''')
+
+        # Исходный текст транзакции появился позже - добавляем столбец в старые базы
+        if 'note' not in self.table_columns(conn, 'transactions'):
+            cursor.execute('ALTER TABLE transactions ADD COLUMN note TEXT')
+
+        # Полнотекстовый индекс по заметкам. Каждое слово индексируется с префиксом
+        # пользователя (см. search_terms), поэтому поиск читает только совпадающие
+        # слова этого пользователя. Триггеры поддерживают индекс в актуальном состоянии.
+        fts_columns = self.table_columns(conn, 'transactions_fts', keep_id=True)
+        if 'user_id' in fts_columns:
+            # Прежний индекс со столбцом user_id пересекал совпадения со всей историей пользователя
+            for trigger in ('insert', 'delete', 'update'):
+                cursor.execute(f'DROP TRIGGER IF EXISTS transactions_fts_{trigger}')
+            cursor.execute('DROP TABLE transactions_fts')
+            fts_columns = []
+        cursor.execute('''
+        CREATE VIRTUAL TABLE IF NOT EXISTS transactions_fts USING fts5(terms, content='')
+        ''')
+        cursor.execute('''
+        CREATE TRIGGER IF NOT EXISTS transactions_fts_insert AFTER INSERT ON transactions BEGIN
+            INSERT INTO transactions_fts (rowid, terms) VALUES (new.id, search_terms(new.user_id, new.note));
+        END
+        ''')
+        cursor.execute('''
+        CREATE TRIGGER IF NOT EXISTS transactions_fts_delete AFTER DELETE ON transactions BEGIN
+            INSERT INTO transactions_fts (transactions_fts, rowid, terms)
+            VALUES ('delete', old.id, search_terms(old.user_id, old.note));
+        END
+        ''')
+        cursor.execute('''
+        CREATE TRIGGER IF NOT EXISTS transactions_fts_update AFTER UPDATE ON transactions BEGIN
+            INSERT INTO transactions_fts (transactions_fts, rowid, terms)
+            VALUES ('delete', old.id, search_terms(old.user_id, old.note));
+            INSERT INTO transactions_fts (rowid, terms) VALUES (new.id, search_terms(new.user_id, new.note));
+        END
+        ''')
+        if not fts_columns:
             cursor.execute('''
-            CREATE TABLE IF NOT EXISTS users (
-                user_id INTEGER PRIMARY KEY,
-                notifications BOOLEAN DEFAULT TRUE,
-                last_activity TEXT
-            )
+            INSERT INTO transactions_fts (rowid, terms)
+            SELECT id, search_terms(user_id, note) FROM transactions WHERE note IS NOT NULL
             ''')
 
-            # Таблица категорий
-            cursor.execute('''
-            CREATE TABLE IF NOT EXISTS categories (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                user_id INTEGER,
-                name TEXT,
-                type TEXT,
-                keywords TEXT,
-                FOREIGN KEY (user_id) REFERENCES users (user_id)
+        # Архив старых транзакций: один сжатый блок на пользователя и год
+        cursor.execute('''
+        CREATE TABLE IF NOT EXISTS archive_chunks (
+            user_id INTEGER,
+            year INTEGER,
+            rows BLOB,
+            PRIMARY KEY (user_id, year)
+        )
+        ''')
+
+        # Итоги по месяцам и категориям, обновляются при каждой вставке транзакции
+        cursor.execute('''
+        CREATE TABLE IF NOT EXISTS transaction_rollups (
+            user_id INTEGER,
+            month TEXT,
+            type TEXT,
+            category TEXT,
+            total REAL,
+            count INTEGER,
+            PRIMARY KEY (user_id, month, type, category)
+        )
+        ''')
+
+        # Ожидаемый следующий шаг диалога (не более одного на пользователя)
+        cursor.execute('''
+        CREATE TABLE IF NOT EXISTS conversation_steps (
+            user_id INTEGER PRIMARY KEY,
+            step TEXT,
+            expires_at REAL
+        )
+        ''')
+        cursor.execute(
+            'CREATE INDEX IF NOT EXISTS idx_conversation_steps_expires ON conversation_steps (expires_at)'
+        )
+
+        # Месячные лимиты расходов по категориям
+        cursor.execute('''
+        CREATE TABLE IF NOT EXISTS budgets (
+            user_id INTEGER,
+            category TEXT,
+            amount REAL,
+            PRIMARY KEY (user_id, category)
+        )
+        ''')
+
+        # Служебные настройки шарда (например, количество шардов)
+        cursor.execute('''
+        CREATE TABLE IF NOT EXISTS meta (
+            key TEXT PRIMARY KEY,
+            value TEXT
+        )
+        ''')
+
+        conn.commit()
+
+    def get_meta(self, key, path=None):
+        """Читает служебное значение из шарда (по умолчанию из нулевого)."""
+        with self.connect(path or self.db_name) as conn:
+            cursor = conn.cursor()
+            cursor.execute('SELECT value FROM meta WHERE key = ?', (key,))
+            row = cursor.fetchone()
+            return row['value'] if row else None
+
+    def set_meta(self, key, value, path=None):
+        """Записывает служебное значение в шард (по умолчанию в нулевой)."""
+        with self.connect(path or self.db_name) as conn:
+            conn.execute(
+                'INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)',
+                (key, str(value))
             )
-            ''')
+            conn.commit()
 
-            # Таблица транзакций
-            cursor.execute('''
-            CREATE TABLE IF NOT EXISTS transactions (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                user_id INTEGER,
-                type TEXT,
-                category TEXT,
-                amount REAL,
-                date TEXT,
-                FOREIGN KEY (user_id) REFERENCES users (user_id)
+    def has_data(self, path):
+        """Проверяет, есть ли в файле базы пользователи или транзакции."""
+        with self.connect(path) as conn:
+            cursor = conn.execute(
+                'SELECT EXISTS (SELECT 1 FROM users) OR EXISTS (SELECT 1 FROM transactions) AS has_data'
+            )
+            return bool(cursor.fetchone()['has_data'])
+
+    def check_shard_count(self):
+        """Проверяет, что количество шардов совпадает с тем, с которым записаны данные."""
+        stored = self.get_meta('shard_count')
+        if stored is None and self.has_data(self.db_name):
+            # База создана до разбиения на шарды: все данные лежат в одном файле
+            stored = '1'
+            self.set_meta('shard_count', stored)
+        if stored is None:
+            if self.shard_count > 1:
+                self.allocate_category_ids(self.shard_paths())
+            self.set_meta('shard_count', self.shard_count)
+        elif int(stored) != self.shard_count:
+            raise ValueError(
+                f"База данных разбита на {stored} шардов, а в настройках указано {self.shard_count}. "
+                f"Для перераспределения данных выполните 'python main.py reshard {self.shard_count}' "
+                f"с DB_SHARDS={stored}."
             )
-            ''')
 
-            conn.commit()
+    def reshard(self, shard_count):
+        """
+        Перераспределяет данные пользователей на новое количество шардов.
+
+        Каждый пользователь переносится целиком (все таблицы с user_id) в один
+        шаг ATTACH + INSERT + DELETE, поэтому перенос атомарен для пары шардов.
+        Удвоение количества шардов разделяет каждый шард i на i и i + N.
+        Запускать только при остановленном боте.
+        """
+        old_paths = self.shard_paths()
+        self.shard_count = shard_count
+        self.init_db()
+        self.allocate_category_ids(old_paths + self.shard_paths())
+
+        for source in old_paths:
+            with self.connect(source) as conn:
+                conn.create_function('shard_of', 1, self.shard_index)
+                tables = self.user_tables(conn)
+                for target_index in range(shard_count):
+                    target = self.shard_path(target_index)
+                    if os.path.abspath(target) == os.path.abspath(source):
+                        continue
+                    conn.execute('ATTACH DATABASE ? AS target', (target,))
+                    try:
+                        for table in tables:
+                            columns = ', '.join(self.table_columns(conn, table, table in self.STABLE_ID_TABLES))
+                            conn.execute(
+                                f'INSERT INTO target.{table} ({columns}) '
+                                f'SELECT {columns} FROM main.{table} WHERE shard_of(user_id) = ?',
+                                (target_index,)
+                            )
+                            conn.execute(
+                                f'DELETE FROM main.{table} WHERE shard_of(user_id) = ?',
+                                (target_index,)
+                            )
+                        conn.commit()
+                    except Exception:
+                        conn.rollback()
+                        raise
+                    finally:
+                        conn.execute('DETACH DATABASE target')
+
+        # Лишние шарды после уменьшения количества уже пусты - удаляем файлы
+        for source in old_paths[shard_count:]:
+            if os.path.abspath(source) != os.path.abspath(self.db_name):
+                os.remove(source)
+
+        self.set_meta('shard_count', shard_count)
+        logger.info(f"Данные перераспределены: {len(old_paths)} -> {shard_count} шардов")
+
+    def allocate_category_ids(self, paths):
+        """
+        Выделяет шардам непересекающиеся диапазоны id категорий.
+
+        Шард i выдает новые id начиная с base + i * CATEGORY_ID_RANGE, где base
+        больше всех id, уже выданных в файлах paths. Поэтому при
+        перераспределении категории переносятся со своими id без конфликтов.
+        """
+        top = 0
+        for path in set(paths):
+            with self.connect(path) as conn:
+                row = conn.execute("SELECT MAX(seq) AS seq FROM sqlite_sequence WHERE name = 'categories'").fetchone()
+                top = max(top, row['seq'] or 0)
+
+        base = (top // self.CATEGORY_ID_RANGE + 1) * self.CATEGORY_ID_RANGE
+        for index, path in enumerate(self.shard_paths()):
+            with self.connect(path) as conn:
+                conn.execute("DELETE FROM sqlite_sequence WHERE name = 'categories'")
+                conn.execute(
+                    "INSERT INTO sqlite_sequence (name, seq) VALUES ('categories', ?)",
+                    (base + index * self.CATEGORY_ID_RANGE,)
+                )
+                conn.commit()
+
+    @staticmethod
+    def user_tables(conn):
+        """Возвращает таблицы шарда, в которых есть столбец user_id."""
+        # Виртуальные таблицы (полнотекстовый индекс) обновляются триггерами сами
+        cursor = conn.execute(
+            "SELECT name FROM sqlite_master WHERE type = 'table' AND name NOT LIKE 'sqlite_%' "
+            "AND sql NOT LIKE 'CREATE VIRTUAL TABLE%'"
+        )
+        return [
+            row['name'] for row in cursor.fetchall()
+            if 'user_id' in DatabaseManager.table_columns(conn, row['name'], keep_id=True)
+        ]
+
+    @staticmethod
+    def table_columns(conn, table, keep_id=False):
+        """
+        Возвращает столбцы таблицы.
+
+        Суррогатный id по умолчанию не переносится, чтобы не было конфликтов
+        между шардами. Для таблиц из STABLE_ID_TABLES id нужно передать
+        keep_id=True: он виден пользователю и должен сохраниться.
+        """
+        cursor = conn.execute(f'PRAGMA main.table_info({table})')
+        return [row['name'] for row in cursor.fetchall() if keep_id or row['name'] != 'id']
 
     def add_user(self, user_id):
         """Добавляет нового пользователя в базу данных."""
-        with self.get_connection() as conn:
+        with self.get_connection(user_id) as conn:
             cursor = conn.cursor()
             now = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
 
@@ -124,7 +598,7 @@ class DatabaseManager:
             ('Подарок', 'income', 'подарок,подарили')
         ]
 
-        with self.get_connection() as conn:
+        with self.get_connection(user_id) as conn:
             cursor = conn.cursor()
             for name, type_, keywords in default_categories:
                 cursor.execute(
@@ -135,7 +609,7 @@ class DatabaseManager:
 
     def update_last_activity(self, user_id):
         """Обновляет время последней активности пользователя."""
-        with self.get_connection() as conn:
+        with self.get_connection(user_id) as conn:
             cursor = conn.cursor()
             now = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
             cursor.execute(
@@ -146,7 +620,7 @@ class DatabaseManager:
 
     def get_all_categories(self, user_id, category_type=None):
         """Получает все категории пользователя."""
-        with self.get_connection() as conn:
+        with self.get_connection(user_id) as conn:
             cursor = conn.cursor()
             if category_type:
                 cursor.execute(
@@ -162,7 +636,7 @@ class DatabaseManager:
 
     def add_category(self, user_id, name, category_type, keywords):
         """Добавляет новую категорию для пользователя."""
-        with self.get_connection() as conn:
+        with self.get_connection(user_id) as conn:
             cursor = conn.cursor()
             cursor.execute(
                 'INSERT INTO categories (user_id, name, type, keywords) VALUES (?, ?, ?, ?)',
@@ -173,7 +647,7 @@ class DatabaseManager:
 
     def delete_category(self, category_id, user_id):
         """Удаляет категорию пользователя."""
-        with self.get_connection() as conn:
+        with self.get_connection(user_id) as conn:
             cursor = conn.cursor()
             cursor.execute(
                 'DELETE FROM categories WHERE id = ? AND user_id = ?',
@@ -200,26 +674,123 @@ class DatabaseManager:
         else:
             return 'Другой доход'
 
-    def add_transaction(self, user_id, transaction_type, category, amount, date=None):
-        """Добавляет новую транзакцию."""
+    def add_transaction(self, user_id, transaction_type, category, amount, date=None, note=None):
+        """Добавляет новую транзакцию. note - исходный текст, по которому работает /search."""
         if date is None:
             date = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
 
-        with self.get_connection() as conn:
+        with self.get_connection(user_id) as conn:
             cursor = conn.cursor()
-            cursor.execute(
-                'INSERT INTO transactions (user_id, type, category, amount, date) VALUES (?, ?, ?, ?, ?)',
-                (user_id, transaction_type, category, amount, date)
+            transaction_id, _ = self.insert_transaction(
+                cursor, user_id, transaction_type, category, amount, date, note
             )
             conn.commit()
-            return cursor.lastrowid
+
+        self.recent_cache.append(user_id, [
+            CachedTransaction(transaction_id, user_id, transaction_type, category, amount, date, note)
+        ])
+        return transaction_id
+
+    def add_transactions(self, transactions):
+        """
+        Добавляет пачку транзакций [(user_id, type, category, amount, date, note), ...].
+
+        Транзакции одного шарда записываются одним коммитом, то есть
+        атомарно: после сбоя в базе окажется либо вся их группа, либо ничего.
+
+        Возвращает список той же длины: для каждой транзакции - лимит, который
+        она превысила, в виде (категория, расходы за месяц, лимит), или None.
+        Превышение определяется в той же транзакции БД, что и запись, поэтому
+        параллельные записи не могут его скрыть. Время последней активности
+        пользователей обновляется тем же коммитом, без отдельной записи на сообщение.
+        """
+        crossings = [None] * len(transactions)
+        by_shard = {}
+        for position, transaction in enumerate(transactions):
+            by_shard.setdefault(self.shard_index(transaction[0]), []).append((position, transaction))
+
+        for index, shard_transactions in by_shard.items():
+            with self.connect(self.shard_path(index)) as conn:
+                cursor = conn.cursor()
+                records = []
+                for position, transaction in shard_transactions:
+                    transaction_id, month_total = self.insert_transaction(cursor, *transaction)
+                    records.append(CachedTransaction(transaction_id, *transaction))
+                    crossings[position] = self.budget_crossing(cursor, transaction, month_total)
+                last_activity = {}
+                for record in records:
+                    last_activity[record.user_id] = max(last_activity.get(record.user_id, record.date), record.date)
+                cursor.executemany(
+                    'UPDATE users SET last_activity = ? WHERE user_id = ?',
+                    [(date, user_id) for user_id, date in last_activity.items()]
+                )
+                conn.commit()
+
+            for user_id, user_records in groupby(records, key=lambda record: record.user_id):
+                self.recent_cache.append(user_id, list(user_records))
+
+        return crossings
+
+    @staticmethod
+    def budget_crossing(cursor, transaction, month_total):
+        """
+        Проверяет, перешел ли итог за месяц через лимит именно на этой транзакции.
+
+        month_total - итог по категории сразу после вставки, поэтому итог до нее
+        равен month_total - amount, даже если рядом пишут другие сообщения.
+        """
+        user_id, transaction_type, category, amount = transaction[:4]
+        if transaction_type != 'expense':
+            return None
+        cursor.execute(
+            'SELECT amount FROM budgets WHERE user_id = ? AND category = ?',
+            (user_id, category)
+        )
+        row = cursor.fetchone()
+        if row and month_total - amount <= row['amount'] < month_total:
+            return category, month_total, row['amount']
+        return None
+
+    @staticmethod
+    def insert_transaction(cursor, user_id, transaction_type, category, amount, date, note=None):
+        """
+        Вставляет транзакцию в рамках текущей транзакции БД, без коммита.
+
+        В той же транзакции БД увеличивается итог за месяц по категории,
+        поэтому итоги всегда совпадают с таблицей transactions.
+        Возвращает (id транзакции, итог по категории за месяц после вставки).
+        """
+        cursor.execute(
+            'INSERT INTO transactions (user_id, type, category, amount, date, note) VALUES (?, ?, ?, ?, ?, ?)',
+            (user_id, transaction_type, category, amount, date, note)
+        )
+        transaction_id = cursor.lastrowid
+        cursor.execute('''
+            INSERT INTO transaction_rollups (user_id, month, type, category, total, count)
+            VALUES (?, ?, ?, ?, ?, 1)
+            ON CONFLICT (user_id, month, type, category)
+            DO UPDATE SET total = total + excluded.total, count = count + 1
+            RETURNING total
+            ''', (user_id, date[:7], transaction_type, category, amount))
+        return transaction_id, cursor.fetchone()[0]
 
     def get_transactions(self, user_id, start_date=None, end_date=None, category=None, transaction_type=None):
         """Получает транзакции пользователя с возможностью фильтрации."""
-        with self.get_connection() as conn:
+        recent = self.get_recent_transactions(user_id, start_date)
+        if recent is not None:
+            return [
+                tx for tx in reversed(recent)
+                if tx.date >= start_date
+                and (not end_date or tx.date <= end_date)
+                and (not category or tx.category == category)
+                and (not transaction_type or tx.type == transaction_type)
+            ]
+
+        with self.get_connection(user_id) as conn:
             cursor = conn.cursor()
 
-            query = 'SELECT * FROM transactions WHERE user_id = ?'
+            source = self.transactions_source(conn, user_id, start_date, end_date)
+            query = f'SELECT * FROM {source} WHERE user_id = ?'
             params = [user_id]
 
             if start_date:
@@ -245,12 +816,25 @@ class DatabaseManager:
 
     def get_categories_summary(self, user_id, start_date=None, end_date=None, transaction_type=None):
         """Получает сумму по категориям за определенный период."""
-        with self.get_connection() as conn:
+        recent = self.get_recent_transactions(user_id, start_date)
+        if recent is not None:
+            totals = {}
+            for tx in recent:
+                if tx.date >= start_date and (not end_date or tx.date <= end_date) \
+                        and (not transaction_type or tx.type == transaction_type):
+                    totals[tx.category] = totals.get(tx.category, 0) + tx.amount
+            return [
+                {'category': category, 'total_amount': total}
+                for category, total in sorted(totals.items(), key=lambda item: item[1], reverse=True)
+            ]
+
+        with self.get_connection(user_id) as conn:
             cursor = conn.cursor()
 
-            query = '''
+            source = self.transactions_source(conn, user_id, start_date, end_date)
+            query = f'''
             SELECT category, SUM(amount) as total_amount 
-            FROM transactions 
+            FROM {source} 
             WHERE user_id = ?
             '''
             params = [user_id]
@@ -272,16 +856,275 @@ class DatabaseManager:
             cursor.execute(query, params)
             return cursor.fetchall()
 
+    def get_recent_transactions(self, user_id, start_date):
+        """
+        Возвращает транзакции пользователя за текущую неделю из кэша (по возрастанию даты).
+
+        Если период начинается раньше текущей недели, возвращает None и
+        запрос идет в базу. При промахе неделя загружается из базы в кэш.
+        """
+        window_start = self.recent_cache.window_start()
+        if not start_date or start_date < window_start:
+            return None
+
+        records = self.recent_cache.get(user_id, start_date)
+        if records is not None:
+            return records
+
+        if not self.recent_cache.begin_load(user_id, window_start):
+            return None
+        with self.get_connection(user_id) as conn:
+            cursor = conn.cursor()
+            cursor.execute(
+                'SELECT id, user_id, type, category, amount, date, note FROM transactions '
+                'WHERE user_id = ? AND date >= ? ORDER BY date',
+                (user_id, window_start)
+            )
+            records = [CachedTransaction(*row) for row in cursor.fetchall()]
+        self.recent_cache.finish_load(user_id, records)
+        cached = self.recent_cache.get(user_id, start_date)
+        return cached if cached is not None else records
+
+    def transactions_source(self, conn, user_id, start_date, end_date):
+        """
+        Возвращает источник транзакций для запроса за период.
+
+        Если период не заходит в архив, это просто таблица transactions.
+        Иначе нужные годы из архива распаковываются во временную таблицу
+        соединения и объединяются с горячими данными.
+        """
+        if self.archived_before is None or (start_date and start_date >= self.archived_before):
+            return 'transactions'
+
+        first_year = int(start_date[:4]) if start_date else 0
+        last_year = int(end_date[:4]) if end_date else int(self.archived_before[:4])
+        cursor = conn.cursor()
+        cursor.execute(
+            'SELECT rows FROM archive_chunks WHERE user_id = ? AND year BETWEEN ? AND ?',
+            (user_id, first_year, last_year)
+        )
+        chunks = cursor.fetchall()
+        if not chunks:
+            return 'transactions'
+
+        cursor.execute('CREATE TEMP TABLE IF NOT EXISTS archived_transactions AS SELECT * FROM transactions WHERE 0')
+        cursor.execute('DELETE FROM temp.archived_transactions')
+        for chunk in chunks:
+            for row in json.loads(zlib.decompress(chunk['rows'])):
+                columns = ', '.join(row)
+                placeholders = ', '.join('?' * len(row))
+                cursor.execute(
+                    f'INSERT INTO temp.archived_transactions ({columns}) VALUES ({placeholders})',
+                    list(row.values())
+                )
+        return '(SELECT * FROM transactions UNION ALL SELECT * FROM temp.archived_transactions)'
+
+    def archive_transactions(self, horizon_days=ARCHIVE_HORIZON_DAYS):
+        """
+        Переносит транзакции старше горизонта в сжатые годовые блоки архива.
+
+        Граница округляется до начала года, поэтому в горячей таблице всегда
+        остаются целые годы. Для архивных месяцев сохраняются итоги в
+        transaction_rollups. Возвращает количество перенесенных транзакций.
+        """
+        cutoff_year = (datetime.now() - timedelta(days=horizon_days)).year
+        cutoff = f"{cutoff_year:04d}-01-01 00:00:00"
+        if self.archived_before is not None and self.archived_before >= cutoff:
+            return 0
+
+        # Сначала сдвигаем границу: если перенос прервется, чтение лишь зря заглянет в архив
+        self.set_meta('archived_before', cutoff)
+        self.archived_before = cutoff
+
+        archived = 0
+        for path in self.shard_paths():
+            with self.connect(path) as conn:
+                cursor = conn.cursor()
+                cursor.execute(
+                    'SELECT * FROM transactions WHERE date < ? ORDER BY user_id, date',
+                    (cutoff,)
+                )
+                for (user_id, year), year_rows in groupby(cursor, key=lambda row: (row['user_id'], row['date'][:4])):
+                    new_rows = [dict(row) for row in year_rows]
+                    archived += len(new_rows)
+                    self.write_archive_chunk(conn, user_id, int(year), new_rows)
+                cursor.execute('DELETE FROM transactions WHERE date < ?', (cutoff,))
+                conn.commit()
+
+        logger.info(f"В архив перенесено {archived} транзакций (до {cutoff})")
+        return archived
+
+    @staticmethod
+    def write_archive_chunk(conn, user_id, year, new_rows):
+        """Дописывает транзакции в годовой блок архива и пересчитывает итоги за его месяцы."""
+        cursor = conn.cursor()
+        cursor.execute(
+            'SELECT rows FROM archive_chunks WHERE user_id = ? AND year = ?',
+            (user_id, year)
+        )
+        existing = cursor.fetchone()
+        rows = json.loads(zlib.decompress(existing['rows'])) if existing else []
+        rows.extend(new_rows)
+
+        cursor.execute(
+            'INSERT OR REPLACE INTO archive_chunks (user_id, year, rows) VALUES (?, ?, ?)',
+            (user_id, year, zlib.compress(json.dumps(rows, ensure_ascii=False).encode(), 9))
+        )
+
+        rollups = {}
+        for row in rows:
+            key = (row['date'][:7], row['type'], row['category'])
+            total, count = rollups.get(key, (0.0, 0))
+            rollups[key] = (total + row['amount'], count + 1)
+
+        cursor.executemany(
+            'INSERT OR REPLACE INTO transaction_rollups (user_id, month, type, category, total, count) '
+            'VALUES (?, ?, ?, ?, ?, ?)',
+            [(user_id, month, type_, category, total, count)
+             for (month, type_, category), (total, count) in rollups.items()]
+        )
+
+    def get_monthly_summary(self, user_id, start_month, end_month, transaction_type='expense'):
+        """
+        Получает суммы по месяцам и категориям за месяцы start_month..end_month ('ГГГГ-ММ').
+
+        Читает готовые итоги из transaction_rollups (и для горячих, и для
+        архивных месяцев), поэтому стоимость не зависит от числа транзакций.
+        """
+        with self.get_connection(user_id) as conn:
+            cursor = conn.cursor()
+            cursor.execute('''
+            SELECT month, category, total as total_amount
+            FROM transaction_rollups
+            WHERE user_id = ? AND type = ? AND month >= ? AND month <= ?
+            ORDER BY month
+            ''', (user_id, transaction_type, start_month, end_month))
+            return cursor.fetchall()
+
+    @staticmethod
+    def search_terms(user_id, text):
+        """
+        Превращает текст в слова полнотекстового индекса с префиксом пользователя.
+
+        "кафе у дома" пользователя 42 -> "u42xкафе u42xу u42xдома". Цифры id
+        заканчиваются на первой букве x, поэтому слова разных пользователей не
+        совпадают. Разделители те же, что у токенизатора FTS5 (включая '_').
+        """
+        if not text:
+            return ''
+        return ' '.join(f'u{user_id}x{word}' for word in re.findall(r'[^\W_]+', text.lower()))
+
+    def search_transactions(self, user_id, query, limit, offset=0):
+        """
+        Ищет транзакции пользователя по тексту заметки, лучшие совпадения первыми.
+
+        Каждое слово запроса ищется как префикс ("обед" найдет "обеда"), все
+        слова должны встретиться. Пользователь входит в каждое слово индекса,
+        поэтому поиск читает только совпадающие слова этого пользователя и его
+        время зависит от количества совпадений, а не от размера истории.
+        """
+        terms = self.search_terms(user_id, query).split()
+        if not terms:
+            return []
+        match = ' AND '.join(f'"{term}"*' for term in terms)
+
+        with self.get_connection(user_id) as conn:
+            cursor = conn.cursor()
+            cursor.execute('''
+            SELECT t.*
+            FROM transactions_fts
+            JOIN transactions t ON t.id = transactions_fts.rowid
+            WHERE transactions_fts MATCH ?
+            ORDER BY bm25(transactions_fts), t.date DESC
+            LIMIT ? OFFSET ?
+            ''', (match, limit, offset))
+            return cursor.fetchall()
+
+    def set_budget(self, user_id, category, amount):
+        """Устанавливает месячный лимит расходов по категории (0 - удалить лимит)."""
+        with self.get_connection(user_id) as conn:
+            if amount > 0:
+                conn.execute(
+                    'INSERT OR REPLACE INTO budgets (user_id, category, amount) VALUES (?, ?, ?)',
+                    (user_id, category, amount)
+                )
+            else:
+                conn.execute(
+                    'DELETE FROM budgets WHERE user_id = ? AND category = ?',
+                    (user_id, category)
+                )
+            conn.commit()
+
+    def get_budgets(self, user_id, month):
+        """Получает лимиты пользователя и расходы по ним за месяц month ('ГГГГ-ММ')."""
+        with self.get_connection(user_id) as conn:
+            cursor = conn.cursor()
+            cursor.execute('''
+            SELECT b.category, b.amount AS limit_amount, COALESCE(r.total, 0) AS spent
+            FROM budgets b
+            LEFT JOIN transaction_rollups r
+                ON r.user_id = b.user_id AND r.month = ? AND r.type = 'expense' AND r.category = b.category
+            WHERE b.user_id = ?
+            ORDER BY b.category
+            ''', (month, user_id))
+            return cursor.fetchall()
+
+    def set_conversation_step(self, user_id, step, ttl=CONVERSATION_TTL_SECONDS):
+        """Запоминает, что следующее сообщение пользователя относится к шагу step."""
+        with self.get_connection(user_id) as conn:
+            conn.execute(
+                'INSERT OR REPLACE INTO conversation_steps (user_id, step, expires_at) VALUES (?, ?, ?)',
+                (user_id, step, time.time() + ttl)
+            )
+            conn.commit()
+
+    def pop_conversation_step(self, user_id):
+        """Возвращает и удаляет ожидаемый шаг диалога пользователя (None, если его нет или он истек)."""
+        with self.get_connection(user_id) as conn:
+            cursor = conn.cursor()
+            cursor.execute(
+                'SELECT step, expires_at FROM conversation_steps WHERE user_id = ?',
+                (user_id,)
+            )
+            row = cursor.fetchone()
+            if row is None:
+                return None
+            cursor.execute('DELETE FROM conversation_steps WHERE user_id = ?', (user_id,))
+            conn.commit()
+            return row['step'] if row['expires_at'] > time.time() else None
+
+    def sweep_conversation_steps(self, max_pending=CONVERSATION_MAX_PENDING):
+        """Удаляет истекшие шаги диалогов и самые старые сверх лимита max_pending на шард."""
+        removed = 0
+        for path in self.shard_paths():
+            with self.connect(path) as conn:
+                cursor = conn.cursor()
+                cursor.execute('DELETE FROM conversation_steps WHERE expires_at <= ?', (time.time(),))
+                removed += cursor.rowcount
+                cursor.execute('''
+                DELETE FROM conversation_steps WHERE user_id IN (
+                    SELECT user_id FROM conversation_steps
+                    ORDER BY expires_at DESC
+                    LIMIT -1 OFFSET ?
+                )
+                ''', (max_pending,))
+                removed += cursor.rowcount
+                conn.commit()
+        return removed
+
     def get_notification_users(self):
         """Получает список пользователей с включенными уведомлениями."""
-        with self.get_connection() as conn:
-            cursor = conn.cursor()
-            cursor.execute('SELECT user_id FROM users WHERE notifications = TRUE')
-            return [row['user_id'] for row in cursor.fetchall()]
+        users = []
+        for path in self.shard_paths():
+            with self.connect(path) as conn:
+                cursor = conn.cursor()
+                cursor.execute('SELECT user_id FROM users WHERE notifications = TRUE')
+                users.extend(row['user_id'] for row in cursor.fetchall())
+        return users
 
     def toggle_notifications(self, user_id, status):
         """Включает или выключает уведомления для пользователя."""
-        with self.get_connection() as conn:
+        with self.get_connection(user_id) as conn:
             cursor = conn.cursor()
             cursor.execute(
                 'UPDATE users SET notifications = ? WHERE user_id = ?',
@@ -292,26 +1135,273 @@ class DatabaseManager:
 
     def get_notification_status(self, user_id):
         """Получает статус уведомлений пользователя."""
-        with self.get_connection() as conn:
+        with self.get_connection(user_id) as conn:
             cursor = conn.cursor()
             cursor.execute('SELECT notifications FROM users WHERE user_id = ?', (user_id,))
             result = cursor.fetchone()
             return result['notifications'] if result else True
 
 
+# Класс для групповой записи транзакций
+class TransactionIngestor:
+    """
+    Очередь транзакций с фоновой групповой записью (group commit).
+
+    Транзакции из разных сообщений копятся в памяти и записываются одним
+    коммитом на шард каждые flush_interval секунд или каждые batch_size строк,
+    поэтому пропускная способность растет с размером пачки, а не с числом fsync.
+
+    Гарантия сохранности: транзакции одного сообщения ставятся в очередь
+    одним элементом с одним Future и всегда попадают в одну пачку. Future
+    завершается только после коммита этой пачки, а подтверждение
+    пользователю отправляется после future.result(), поэтому подтвержденные
+    транзакции всегда есть в базе. Транзакции, ожидавшие в очереди в момент
+    падения процесса, теряются, но и подтверждения по ним никто не получил.
+    Пачка одного шарда записывается атомарно: после сбоя посреди коммита
+    SQLite откатывает ее целиком, так что сообщение сохраняется либо целиком,
+    либо никак. Если коммит не удался, Future получает исключение.
+    """
+
+    def __init__(self, db, flush_interval=0.005, batch_size=100):
+        self.db = db
+        self.flush_interval = flush_interval
+        self.batch_size = batch_size
+        self.queue = queue.Queue()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def submit(self, transactions):
+        """
+        Ставит транзакции одного сообщения [(user_id, type, category, amount, date, note), ...]
+        в очередь и возвращает Future, который завершится после их коммита.
+        """
+        future = Future()
+        self.queue.put((transactions, future))
+        return future
+
+    def stop(self):
+        """Записывает все, что осталось в очереди, и останавливает фоновый поток."""
+        self.queue.put(None)
+        self.thread.join()
+
+    def run(self):
+        """Фоновый цикл: собирает пачку и записывает ее."""
+        while True:
+            item = self.queue.get()
+            if item is None:
+                return
+
+            batch = [item]
+            size = len(item[0])
+            deadline = time.monotonic() + self.flush_interval
+            stopping = False
+            while size < self.batch_size:
+                timeout = deadline - time.monotonic()
+                if timeout <= 0:
+                    break
+                try:
+                    item = self.queue.get(timeout=timeout)
+                except queue.Empty:
+                    break
+                if item is None:
+                    stopping = True
+                    break
+                batch.append(item)
+                size += len(item[0])
+
+            self.commit(batch)
+            if stopping:
+                return
+
+    def commit(self, batch):
+        """Записывает пачку по шардам и завершает соответствующие Future."""
+        # Все транзакции сообщения принадлежат одному пользователю, а значит и одному шарду
+        by_shard = {}
+        for transactions, future in batch:
+            by_shard.setdefault(self.db.shard_index(transactions[0][0]), []).append((transactions, future))
+
+        for shard_batch in by_shard.values():
+            rows = [transaction for transactions, _ in shard_batch for transaction in transactions]
+            try:
+                crossings = self.db.add_transactions(rows)
+            except Exception as e:
+                logger.error(f"Ошибка при групповой записи {len(rows)} транзакций: {e}")
+                for _, future in shard_batch:
+                    future.set_exception(e)
+            else:
+                # Каждый Future получает превышения лимитов по своему сообщению
+                position = 0
+                for transactions, future in shard_batch:
+                    future.set_result(crossings[position:position + len(transactions)])
+                    position += len(transactions)
+
+
 # Создание экземпляра менеджера базы данных
-db = DatabaseManager()
+db = DatabaseManager(DB_PATH, shards=DB_SHARDS)
+
+# Групповая запись включается переменной GROUP_COMMIT=1
+ingestor = TransactionIngestor(
+    db, GROUP_COMMIT_INTERVAL_MS / 1000, GROUP_COMMIT_BATCH_SIZE
+) if GROUP_COMMIT else None
+
+
+# Класс для ограничения частоты запросов пользователей
+class RateLimiter:
+    """
+    Корзины токенов по пользователям.
+
+    Каждая операция списывает из корзины пользователя свою стоимость,
+    корзина пополняется со скоростью refill_rate токенов в секунду до
+    capacity. Корзины хранятся в LRU-словаре не более чем для max_users
+    пользователей; вытесненный пользователь просто получает полную корзину.
+    """
+
+    class Bucket:
+        __slots__ = ('tokens', 'updated', 'warned')
+
+        def __init__(self, tokens, updated):
+            self.tokens = tokens
+            self.updated = updated
+            self.warned = False
+
+    def __init__(self, capacity=RATE_LIMIT_CAPACITY, refill_rate=RATE_LIMIT_REFILL_PER_SEC, max_users=100000):
+        # Без пополнения корзина опустеет навсегда, а время до повтора не определено
+        if capacity > 0 and refill_rate <= 0:
+            raise ValueError(
+                f"RATE_LIMIT_REFILL_PER_SEC должно быть больше нуля, указано {refill_rate}. "
+                f"Чтобы отключить ограничение, укажите RATE_LIMIT_CAPACITY=0."
+            )
+        self.capacity = capacity
+        self.refill_rate = refill_rate
+        self.max_users = max_users
+        self.buckets = OrderedDict()
+        self.lock = threading.Lock()
+
+    def acquire(self, user_id, cost):
+        """
+        Пытается списать cost токенов. Возвращает (через сколько секунд повторить, нужно ли предупредить).
+
+        Ноль секунд означает, что операция разрешена. Предупреждение
+        возвращается только для первого отказа подряд, чтобы не отвечать
+        на каждое лишнее сообщение.
+        """
+        if self.capacity <= 0:
+            return 0, False
+        cost = min(cost, self.capacity)
+        now = time.monotonic()
+
+        with self.lock:
+            bucket = self.buckets.get(user_id)
+            if bucket is None:
+                bucket = self.Bucket(self.capacity, now)
+                self.buckets[user_id] = bucket
+                if len(self.buckets) > self.max_users:
+                    self.buckets.popitem(last=False)
+            else:
+                self.buckets.move_to_end(user_id)
+                bucket.tokens = min(self.capacity, bucket.tokens + (now - bucket.updated) * self.refill_rate)
+                bucket.updated = now
+
+            if bucket.tokens >= cost:
+                bucket.tokens -= cost
+                bucket.warned = False
+                return 0, False
+
+            warn = not bucket.warned
+            bucket.warned = True
+            return (cost - bucket.tokens) / self.refill_rate, warn
+
+
+# Функция для определения стоимости обновления
+def update_cost(text=None, callback_data=None):
+    """Возвращает стоимость сообщения или нажатия кнопки в токенах."""
+    if callback_data is not None:
+        if callback_data.startswith('report_'):
+            return OPERATION_COSTS['report']
+        return OPERATION_COSTS['search' if callback_data.startswith('search_') else 'command']
+    if not text:
+        return OPERATION_COSTS['command']
+    if text.startswith('/trends'):
+        return OPERATION_COSTS['report']
+    if text.startswith('/search'):
+        return OPERATION_COSTS['search']
+    if text.startswith('/'):
+        return OPERATION_COSTS['command']
+    lines = sum(1 for line in text.split('\n') if line.strip())
+    return OPERATION_COSTS['line'] * min(max(lines, 1), MAX_LINES_PER_MESSAGE)
+
+
+# Слой ограничения частоты запросов перед обработчиками
+class RateLimitMiddleware(BaseMiddleware):
+    """Отклоняет сообщения и нажатия кнопок пользователей, исчерпавших лимит."""
+
+    def __init__(self, limiter):
+        super().__init__()
+        self.limiter = limiter
+        self.update_sensitive = True
+        self.update_types = ['message', 'callback_query']
+
+    def pre_process_message(self, message, data):
+        user_id = message.from_user.id
+        retry_after, warn = self.limiter.acquire(user_id, update_cost(text=message.text))
+        if not retry_after:
+            return None
+        if warn:
+            bot.send_message(user_id, f"⏳ Слишком много запросов. Попробуйте через {int(retry_after) + 1} сек.")
+        return CancelUpdate()
+
+    def post_process_message(self, message, data, exception):
+        pass
+
+    def pre_process_callback_query(self, call, data):
+        retry_after, _ = self.limiter.acquire(call.from_user.id, update_cost(callback_data=call.data))
+        if not retry_after:
+            return None
+        bot.answer_callback_query(call.id, f"⏳ Слишком много запросов. Попробуйте через {int(retry_after) + 1} сек.")
+        return CancelUpdate()
+
+    def post_process_callback_query(self, call, data, exception):
+        pass
+
+
+rate_limiter = RateLimiter()
+bot.setup_middleware(RateLimitMiddleware(rate_limiter))
+
+
+# Функция для сохранения транзакций из одного сообщения
+def save_transactions(user_id, transactions):
+    """
+    Сохраняет транзакции [(тип, категория, сумма, заметка), ...] одного сообщения.
+
+    Возвращается только после того, как транзакции записаны в базу,
+    поэтому после нее можно отправлять подтверждение пользователю.
+    Возвращает превышенные этими транзакциями лимиты [(категория, расходы за месяц, лимит), ...].
+    """
+    now = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+    rows = [(user_id, transaction_type, category, amount, now, note)
+            for transaction_type, category, amount, note in transactions]
+    if not rows:
+        return []
+
+    if ingestor is None:
+        crossings = db.add_transactions(rows)
+    else:
+        crossings = ingestor.submit(rows).result()
+    return [crossing for crossing in crossings if crossing]
 
 
 # Обновленная функция для проверки формата ввода трат/доходов
 def parse_transaction_line(text):
     """
-    Парсит строку транзакции и возвращает тип, текст для определения категории и сумму.
+    Парсит строку транзакции и возвращает тип, текст для определения категории, сумму
+    и заметку - исходный текст строки, который сохраняется для поиска.
 
     Форматы:
     - Расходы: "категория сумма" (например, "кафе 599р" или "такси 300")
     - Доходы: "+категория сумма" (например, "+зарплата 50000")
     """
+    note = text.strip()
+
     # Удаляем символы валют и другие лишние символы
     text = text.replace('р', '').replace('₽', '').replace('руб', '')
 
@@ -325,28 +1415,29 @@ def parse_transaction_line(text):
     # Ищем числа в тексте
     numbers = re.findall(r'\b\d+(?:[\.,]\d+)?\b', text)
     if not numbers:
-        return None, None, None
+        return None, None, None, None
 
     # Предполагаем, что последнее число - это сумма
     amount_str = numbers[-1].replace(',', '.')
     try:
         amount = float(amount_str)
     except ValueError:
-        return None, None, None
+        return None, None, None, None
 
     # Удаляем сумму из текста для последующего определения категории
     category_text = re.sub(r'\b' + re.escape(numbers[-1]) + r'\b', '', text).strip()
 
-    return transaction_type, category_text, amount
+    return transaction_type, category_text, amount, note
 
 
 # Обновленная функция для обработки нескольких транзакций
-def parse_multiple_transactions(text):
+def parse_multiple_transactions(text, max_lines=MAX_LINES_PER_MESSAGE):
     """
     Парсит текст, содержащий несколько транзакций, разделенных переносом строки.
-    Возвращает список кортежей (тип, текст для определения категории, сумма).
+    Учитываются только первые max_lines строк.
+    Возвращает список кортежей (тип, текст для определения категории, сумма, заметка).
     """
-    lines = text.strip().split('\n')
+    lines = text.strip().split('\n')[:max_lines]
     transactions = []
 
     for line in lines:
@@ -411,33 +1502,121 @@ def get_report_period(period_type):
     return start_date.strftime('%Y-%m-%d %H:%M:%S'), end_date.strftime('%Y-%m-%d %H:%M:%S')
 
 
-# Функция для создания графика расходов по категориям
-def create_category_chart(user_id, start_date, end_date, transaction_type):
-    """Создает круговую диаграмму расходов/доходов по категориям."""
-    summaries = db.get_categories_summary(user_id, start_date, end_date, transaction_type)
+# Класс с данными отчета за период в виде столбцов
+class ReportData:
+    """
+    Транзакции периода, загруженные один раз в массивы numpy.
 
-    if not summaries:
-        return None
+    Итоги, суммы по категориям, доли и расходы по дням считаются
+    векторно (маски, np.bincount) вместо прохода по строкам в Python.
+    Транзакции ожидаются в порядке убывания даты, как их возвращает
+    DatabaseManager.get_transactions.
+    """
+
+    def __init__(self, transactions):
+        self.transactions = transactions
+        self.amounts = np.array([tx['amount'] for tx in transactions], dtype=np.float64)
+        self.is_expense = np.array([tx['type'] == 'expense' for tx in transactions], dtype=bool)
+        self.dates = np.array([tx['date'] for tx in transactions], dtype='U19')
+        self.category_names, self.category_codes = np.unique(
+            np.array([tx['category'] for tx in transactions], dtype=str), return_inverse=True
+        )
+
+    def __len__(self):
+        return len(self.transactions)
+
+    def mask(self, transaction_type):
+        """Маска транзакций указанного типа."""
+        return self.is_expense if transaction_type == 'expense' else ~self.is_expense
+
+    def count(self, transaction_type):
+        """Количество транзакций указанного типа."""
+        return int(np.count_nonzero(self.mask(transaction_type)))
 
-    # Создаем данные для диаграммы
-    labels = [summary['category'] for summary in summaries]
-    amounts = [summary['total_amount'] for summary in summaries]
+    def total(self, transaction_type):
+        """Сумма транзакций указанного типа."""
+        return float(self.amounts[self.mask(transaction_type)].sum())
 
-    # Создаем круговую диаграмму
-    plt.figure(figsize=(10, 7))
-    plt.pie(amounts, labels=labels, autopct='%1.1f%%', startangle=90)
-    plt.axis('equal')  # Чтобы круг был круглым
+    def category_totals(self, transaction_type):
+        """Возвращает названия категорий, суммы и доли в процентах по убыванию суммы."""
+        mask = self.mask(transaction_type)
+        totals = np.bincount(
+            self.category_codes[mask], weights=self.amounts[mask], minlength=len(self.category_names)
+        )
+        order = np.argsort(-totals, kind='stable')
+        order = order[totals[order] > 0]
+        total = totals.sum()
+        percents = totals[order] / total * 100 if total else np.zeros(len(order))
+        return self.category_names[order].tolist(), totals[order].tolist(), percents.tolist()
+
+    def daily_totals(self, transaction_type):
+        """Возвращает дни ('ГГГГ-ММ-ДД') и суммы за каждый день."""
+        mask = self.mask(transaction_type)
+        days, codes = np.unique(self.dates[mask].astype('U10'), return_inverse=True)
+        return days.tolist(), np.bincount(codes, weights=self.amounts[mask], minlength=len(days)).tolist()
+
+
+# Функция для создания графика расходов по категориям
+def create_category_chart(labels, amounts, transaction_type):
+    """Создает круговую диаграмму расходов/доходов по готовым суммам по категориям."""
+    if not labels:
+        return None
+
+    # Создаем круговую диаграмму на отдельной Figure, без глобального состояния pyplot
+    fig = Figure(figsize=(10, 7))
+    ax = fig.subplots()
+    ax.pie(amounts, labels=labels, autopct='%1.1f%%', startangle=90)
+    ax.axis('equal')  # Чтобы круг был круглым
     if transaction_type == 'expense':
         title = 'Расходы по категориям'
     else:
         title = 'Доходы по категориям'
-    plt.title(title)
+    ax.set_title(title)
 
     # Сохраняем диаграмму в байтовый поток
     buffer = io.BytesIO()
-    plt.savefig(buffer, format='png')
+    fig.savefig(buffer, format='png')
+    buffer.seek(0)
+
+    return buffer
+
+
+# Функция для получения списка месяцев для отчета о динамике
+def get_trend_months(count):
+    """Возвращает последние count месяцев (включая текущий) в формате 'ГГГГ-ММ'."""
+    now = datetime.now()
+    months = []
+    year, month = now.year, now.month
+    for _ in range(count):
+        months.append(f"{year:04d}-{month:02d}")
+        month -= 1
+        if month == 0:
+            year, month = year - 1, 12
+    return months[::-1]
+
+
+# Функция для создания графика динамики расходов
+def create_trends_chart(months, series):
+    """Создает столбчатую диаграмму расходов по месяцам с разбивкой по категориям."""
+    # Отдельная Figure вместо глобального состояния pyplot: обработчики работают в нескольких потоках
+    fig = Figure(figsize=(10, 7))
+    ax = fig.subplots()
+    positions = range(len(months))
+    bottom = [0.0] * len(months)
+    for category, amounts in series.items():
+        ax.bar(positions, amounts, bottom=bottom, label=category)
+        bottom = [b + a for b, a in zip(bottom, amounts)]
+
+    ax.plot(positions, bottom, color='black', marker='o', label='Всего')
+    ax.set_title('Расходы по месяцам')
+    ax.set_xticks(positions)
+    ax.set_xticklabels(months, rotation=45)
+    ax.legend()
+    fig.tight_layout()
+
+    buffer = io.BytesIO()
+    fig.savefig(buffer, format='png')
     buffer.seek(0)
-    plt.close()
 
     return buffer
 
@@ -471,6 +1650,9 @@ def help_command(message):
         "/start - начало работы с ботом\n"
         "/help - показать эту справку\n"
         "/report - сформировать отчет за период\n"
+        "/trends - динамика расходов по месяцам (например, `/trends 12`)\n"
+        "/budget - месячные лимиты расходов (например, `/budget кафе 5000`)\n"
+        "/search - поиск транзакций по тексту (например, `/search обед`)\n"
         "/categories - управление категориями\n"
         "/notifications - управление уведомлениями\n\n"
 
@@ -506,6 +1688,130 @@ def report_command(message):
     )
 
 
+# Обработчик команды /trends
+@bot.message_handler(commands=['trends'])
+def trends_command(message):
+    """Обрабатывает команду /trends [количество месяцев]."""
+    user_id = message.from_user.id
+    db.update_last_activity(user_id)
+
+    parts = message.text.split()
+    months_count = TRENDS_DEFAULT_MONTHS
+    if len(parts) > 1:
+        if not parts[1].isdigit() or not 2 <= int(parts[1]) <= TRENDS_MAX_MONTHS:
+            bot.send_message(
+                user_id,
+                f"❌ Укажите количество месяцев от 2 до {TRENDS_MAX_MONTHS}, например: `/trends 6`",
+                parse_mode='Markdown'
+            )
+            return
+        months_count = int(parts[1])
+
+    generate_trends_report(user_id, months_count)
+
+
+# Обработчик команды /search
+@bot.message_handler(commands=['search'])
+def search_command(message):
+    """Обрабатывает команду /search текст."""
+    user_id = message.from_user.id
+    db.update_last_activity(user_id)
+
+    parts = message.text.split(maxsplit=1)
+    if len(parts) < 2 or not parts[1].strip():
+        bot.send_message(
+            user_id,
+            "🔎 Напишите, что искать, например: `/search обед`",
+            parse_mode='Markdown'
+        )
+        return
+
+    send_search_results(user_id, parts[1].strip(), 0)
+
+
+# Обработчик команды /budget
+@bot.message_handler(commands=['budget'])
+def budget_command(message):
+    """Обрабатывает команду /budget [категория сумма]."""
+    user_id = message.from_user.id
+    db.update_last_activity(user_id)
+
+    parts = message.text.split()
+    month = datetime.now().strftime('%Y-%m')
+
+    if len(parts) == 1:
+        budgets = db.get_budgets(user_id, month)
+        if not budgets:
+            bot.send_message(
+                user_id,
+                "У вас нет лимитов расходов.\n\n"
+                "Чтобы установить лимит на месяц, напишите: `/budget категория сумма`\n"
+                "Например: `/budget кафе 5000`. Сумма 0 удаляет лимит.",
+                parse_mode='Markdown'
+            )
+            return
+
+        lines = ["💼 *Лимиты расходов на этот месяц:*\n"]
+        for budget in budgets:
+            mark = "⚠️" if budget['spent'] > budget['limit_amount'] else "✅"
+            lines.append(f"{mark} *{budget['category']}*: {budget['spent']:.2f} из {budget['limit_amount']:.2f} ₽")
+        bot.send_message(user_id, "\n".join(lines), parse_mode='Markdown')
+        return
+
+    amount_text = parts[-1].replace(',', '.')
+    try:
+        amount = float(amount_text)
+    except ValueError:
+        amount = None
+    if len(parts) < 3 or amount is None or amount < 0:
+        bot.send_message(
+            user_id,
+            "❌ Неверный формат. Используйте: `/budget категория сумма`, например `/budget кафе 5000`",
+            parse_mode='Markdown'
+        )
+        return
+
+    category = find_expense_category(user_id, ' '.join(parts[1:-1]))
+    if category is None:
+        bot.send_message(user_id, "❌ Такой категории расходов нет. Посмотреть категории: /categories")
+        return
+
+    db.set_budget(user_id, category, amount)
+    if amount > 0:
+        bot.send_message(user_id, f"✅ Лимит по категории *{category}*: {amount:.2f} ₽ в месяц", parse_mode='Markdown')
+    else:
+        bot.send_message(user_id, f"✅ Лимит по категории *{category}* удален", parse_mode='Markdown')
+
+
+# Функция для поиска категории расходов по названию или ключевому слову
+def find_expense_category(user_id, text):
+    """Возвращает название категории расходов по ее названию или ключевому слову (None, если не найдена)."""
+    text_lower = text.lower()
+    for category in db.get_all_categories(user_id, 'expense'):
+        if category['name'].lower() == text_lower:
+            return category['name']
+
+    category = db.find_category_by_keyword(user_id, text, 'expense')
+    if category == 'Другое' and text_lower != 'другое':
+        return None
+    return category
+
+
+# Функция для форматирования предупреждений о лимитах
+def format_budget_warnings(crossings):
+    """
+    Возвращает предупреждения о лимитах [(категория, расходы за месяц, лимит), ...],
+    которые вернула save_transactions.
+
+    Предупреждение отправляется один раз - тому сообщению, транзакция которого
+    перешла через лимит.
+    """
+    return [
+        f"⚠️ Превышен лимит по категории *{category}*: {spent:.2f} из {limit_amount:.2f} ₽"
+        for category, spent, limit_amount in crossings
+    ]
+
+
 # Обработчик команды /categories
 @bot.message_handler(commands=['categories'])
 def categories_command(message):
@@ -574,8 +1880,13 @@ def handle_callback_query(call):
             "Типы: expense (расход) или income (доход)\n"
             "Пример: `expense Такси такси,яндекс,убер,каршеринг`"
         )
-        # Устанавливаем следующий шаг обработки
-        bot.register_next_step_handler(call.message, process_new_category)
+        # Следующее сообщение пользователя будет описанием категории
+        db.set_conversation_step(user_id, 'new_category')
+
+    # Обработка колбэков для следующих страниц поиска
+    elif call.data.startswith('search_'):
+        _, offset, query = call.data.split('_', 2)
+        send_search_results(user_id, query, int(offset))
 
     elif call.data == 'delete_category':
         # Показываем список категорий для удаления
@@ -692,13 +2003,15 @@ def generate_report(user_id, period_type):
         bot.send_message(user_id, "❌ Неверный период для отчета.")
         return
 
-    # Получаем транзакции за указанный период
-    expenses = db.get_transactions(user_id, start_date, end_date, transaction_type='expense')
-    incomes = db.get_transactions(user_id, start_date, end_date, transaction_type='income')
+    # Загружаем транзакции за период одним запросом и считаем все по столбцам
+    all_transactions = db.get_transactions(user_id, start_date, end_date)
+    report = ReportData(all_transactions)
+    expenses = report.count('expense')
+    incomes = report.count('income')
 
     # Считаем общие суммы
-    total_expense = sum(expense['amount'] for expense in expenses)
-    total_income = sum(income['amount'] for income in incomes)
+    total_expense = report.total('expense')
+    total_income = report.total('income')
     balance = total_income - total_expense
 
     # Форматируем период для отображения
@@ -714,16 +2027,34 @@ def generate_report(user_id, period_type):
 
     period_display = period_format.get(period_type, '')
 
+    expense_labels, expense_amounts, expense_percents = report.category_totals('expense')
+    income_labels, income_amounts, _ = report.category_totals('income')
+
     # Формируем текст отчета
-    report_text = f"📊 *Отчет за {period_display}*\n\n"
+    lines = [
+        f"📊 *Отчет за {period_display}*\n",
+        f"💰 *Доходы:* {total_income:.2f} ₽",
+        f"💸 *Расходы:* {total_expense:.2f} ₽",
+        f"📈 *Баланс:* {balance:.2f} ₽\n",
+    ]
+
+    if expenses:
+        lines.append("🏷 *Больше всего расходов:*")
+        for label, amount, percent in list(zip(expense_labels, expense_amounts, expense_percents))[:3]:
+            lines.append(f"• {label}: {amount:.2f} ₽ ({percent:.1f}%)")
+        lines.append("")
+
+        if period_type != 'day':
+            days, day_totals = report.daily_totals('expense')
+            top_day = int(np.argmax(day_totals))
+            day = days[top_day]
+            lines.append(f"📅 *Самый затратный день:* {day[8:10]}.{day[5:7]}.{day[:4]} ({day_totals[top_day]:.2f} ₽)\n")
 
-    report_text += f"💰 *Доходы:* {total_income:.2f} ₽\n"
-    report_text += f"💸 *Расходы:* {total_expense:.2f} ₽\n"
-    report_text += f"📈 *Баланс:* {balance:.2f} ₽\n\n"
+    report_text = "\n".join(lines) + "\n"
 
     # Создаем и отправляем графики по категориям, если есть данные
     if expenses:
-        expense_chart = create_category_chart(user_id, start_date, end_date, 'expense')
+        expense_chart = create_category_chart(expense_labels, expense_amounts, 'expense')
         if expense_chart:
             bot.send_message(user_id, report_text, parse_mode='Markdown')
             bot.send_photo(user_id, expense_chart, caption="📉 Расходы по категориям")
@@ -734,7 +2065,7 @@ def generate_report(user_id, period_type):
         report_text += "По расходам нет данных для создания графика.\n\n"
 
     if incomes:
-        income_chart = create_category_chart(user_id, start_date, end_date, 'income')
+        income_chart = create_category_chart(income_labels, income_amounts, 'income')
         if income_chart:
             if not expenses:  # Если отчет еще не отправлен
                 bot.send_message(user_id, report_text, parse_mode='Markdown')
@@ -750,7 +2081,6 @@ def generate_report(user_id, period_type):
 
     # Отправляем детализацию транзакций
     if expenses or incomes:
-        all_transactions = db.get_transactions(user_id, start_date, end_date)
         if len(all_transactions) > 15:
             # Если транзакций много, отправляем только последние 15
             bot.send_message(
@@ -767,23 +2097,108 @@ def generate_report(user_id, period_type):
             )
 
 
+# Функция для генерации отчета о динамике расходов
+def generate_trends_report(user_id, months_count):
+    """Генерирует и отправляет динамику расходов по месяцам с разницей к прошлому месяцу."""
+    months = get_trend_months(months_count)
+    rows = db.get_monthly_summary(user_id, months[0], months[-1], 'expense')
+
+    if not rows:
+        bot.send_message(user_id, "📉 Нет расходов за выбранный период.")
+        return
+
+    # Раскладываем результат в таблицу категория -> суммы по месяцам
+    month_index = {month: i for i, month in enumerate(months)}
+    by_category = {}
+    for row in rows:
+        amounts = by_category.setdefault(row['category'], [0.0] * len(months))
+        amounts[month_index[row['month']]] += row['total_amount']
+
+    totals = [sum(amounts[i] for amounts in by_category.values()) for i in range(len(months))]
+
+    # Крупные категории показываем отдельно, остальные объединяем
+    ranked = sorted(by_category.items(), key=lambda item: sum(item[1]), reverse=True)
+    series = dict(ranked[:TRENDS_TOP_CATEGORIES])
+    if len(ranked) > TRENDS_TOP_CATEGORIES:
+        rest = [sum(amounts[i] for _, amounts in ranked[TRENDS_TOP_CATEGORIES:]) for i in range(len(months))]
+        series['Остальное'] = rest
+
+    lines = [f"📈 *Динамика расходов за {months_count} мес.*\n"]
+    for i, month in enumerate(months):
+        month_display = datetime.strptime(month, '%Y-%m').strftime('%m.%Y')
+        line = f"{month_display}: {totals[i]:.2f} ₽"
+        if i > 0:
+            line += f" ({format_delta(totals[i], totals[i - 1])})"
+        lines.append(line)
+
+    lines.append("\n*Изменение к прошлому месяцу по категориям:*")
+    for category, amounts in series.items():
+        lines.append(f"• {category}: {amounts[-1]:.2f} ₽ ({format_delta(amounts[-1], amounts[-2])})")
+
+    bot.send_message(user_id, "\n".join(lines), parse_mode='Markdown')
+    bot.send_photo(user_id, create_trends_chart(months, series), caption="📊 Расходы по месяцам")
+
+
+# Функция для форматирования изменения суммы
+def format_delta(current, previous):
+    """Форматирует изменение суммы относительно предыдущего месяца."""
+    delta = current - previous
+    if previous:
+        return f"{delta:+.2f} ₽, {delta / previous * 100:+.1f}%"
+    return f"{delta:+.2f} ₽"
+
+
+# Функция для экранирования текста в сообщениях с parse_mode='Markdown'
+def escape_legacy_markdown(text):
+    """
+    Экранирует служебные символы старого режима Markdown: _ * ` [
+
+    telebot.formatting.escape_markdown рассчитан на MarkdownV2 и экранирует
+    также + . - и другие символы, которые в старом режиме остались бы в тексте.
+    """
+    return re.sub(r'([_*`\[])', r'\\\1', text)
+
+
+# Функция для отправки страницы результатов поиска
+def send_search_results(user_id, query, offset):
+    """Отправляет страницу результатов поиска с кнопкой следующей страницы."""
+    # Запрашиваем на одну запись больше, чтобы понять, есть ли следующая страница
+    rows = db.search_transactions(user_id, query, SEARCH_PAGE_SIZE + 1, offset)
+    if not rows:
+        text = "🔎 Ничего не найдено." if offset == 0 else "🔎 Больше результатов нет."
+        bot.send_message(user_id, text)
+        return
+
+    page = rows[:SEARCH_PAGE_SIZE]
+    lines = [f"🔎 *Результаты поиска* ({offset + 1}-{offset + len(page)}):\n"]
+    for tx in page:
+        date_str = datetime.strptime(tx['date'], '%Y-%m-%d %H:%M:%S').strftime('%d.%m.%Y %H:%M')
+        symbol = "➖" if tx['type'] == 'expense' else "➕"
+        lines.append(f"{date_str} {symbol} *{tx['category']}*: {tx['amount']:.2f} ₽")
+        lines.append(f"  {escape_legacy_markdown(tx['note'])}")
+
+    markup = None
+    callback_data = f"search_{offset + SEARCH_PAGE_SIZE}_{query}"
+    # Telegram ограничивает данные кнопки 64 байтами - для длинных запросов кнопки не будет
+    if len(rows) > SEARCH_PAGE_SIZE and len(callback_data.encode()) <= 64:
+        markup = types.InlineKeyboardMarkup()
+        markup.add(types.InlineKeyboardButton("Дальше ➡️", callback_data=callback_data))
+
+    bot.send_message(user_id, "\n".join(lines), parse_mode='Markdown', reply_markup=markup)
+
+
 # Функция для форматирования списка транзакций
 def format_transactions(transactions):
     """Форматирует список транзакций для отображения."""
     if not transactions:
         return "Нет транзакций."
 
-    result = ""
-    for tx in transactions:
-        date_obj = datetime.strptime(tx['date'], '%Y-%m-%d %H:%M:%S')
-        date_str = date_obj.strftime('%d.%m.%Y %H:%M')
-
-        # Определяем символ для типа транзакции
-        symbol = "➖" if tx['type'] == 'expense' else "➕"
-
-        result += f"{date_str} {symbol} *{tx['category']}*: {tx['amount']:.2f} ₽\n"
-
-    return result
+    # Дата хранится как 'ГГГГ-ММ-ДД ЧЧ:ММ:СС', поэтому переставляем части строки без strptime
+    return "".join(
+        f"{tx['date'][8:10]}.{tx['date'][5:7]}.{tx['date'][:4]} {tx['date'][11:16]} "
+        f"{'➖' if tx['type'] == 'expense' else '➕'} *{tx['category']}*: {tx['amount']:.2f} ₽\n"
+        for tx in transactions
+    )
 
 
 # Функция для отправки ежедневных напоминаний
@@ -803,11 +2218,35 @@ def send_daily_reminders():
             logger.error(f"Ошибка при отправке напоминания пользователю {user_id}: {e}")
 
 
+# Функция для очистки незавершенных диалогов
+def sweep_conversations():
+    """Удаляет брошенные диалоги."""
+    try:
+        removed = db.sweep_conversation_steps()
+        if removed:
+            logger.info(f"Удалено {removed} незавершенных диалогов")
+    except Exception as e:
+        logger.error(f"Ошибка при очистке диалогов: {e}")
+
+
+# Функция для переноса старых транзакций в архив
+def archive_old_transactions():
+    """Переносит транзакции старше ARCHIVE_HORIZON_DAYS в архив."""
+    try:
+        db.archive_transactions(ARCHIVE_HORIZON_DAYS)
+    except Exception as e:
+        logger.error(f"Ошибка при архивации транзакций: {e}")
+
+
 # Запускаем планировщик в отдельном потоке
 def run_scheduler():
     """Запускает планировщик задач в отдельном потоке."""
     # Планируем ежедневное напоминание на 21:00
     schedule.every().day.at("21:00").do(send_daily_reminders)
+    # Архивация старых транзакций ночью, когда нагрузка минимальна
+    schedule.every().day.at("04:00").do(archive_old_transactions)
+    # Очистка брошенных диалогов
+    schedule.every(10).minutes.do(sweep_conversations)
 
     while True:
         schedule.run_pending()
@@ -819,7 +2258,16 @@ def run_scheduler():
 def handle_message(message):
     """Обрабатывает все текстовые сообщения как возможные транзакции."""
     user_id = message.from_user.id
-    db.update_last_activity(user_id)
+    # Для сообщений с транзакциями время активности обновляет add_transactions тем же
+    # коммитом, что и транзакции; отдельная запись нужна только в остальных ветках
+
+    # Если бот ждет от пользователя ответа на шаг диалога, передаем сообщение этому шагу
+    step = db.pop_conversation_step(user_id)
+    if step in CONVERSATION_STEPS:
+        db.update_last_activity(user_id)
+        CONVERSATION_STEPS[step](message)
+        return
+
     text = message.text.strip()
 
     # Проверяем, содержит ли сообщение несколько строк
@@ -829,6 +2277,7 @@ def handle_message(message):
 
         if not transactions:
             # Если не распознали ни одной транзакции
+            db.update_last_activity(user_id)
             bot.send_message(
                 user_id,
                 "❌ Не удалось распознать транзакции. Используйте формат:\n"
@@ -840,19 +2289,18 @@ def handle_message(message):
             )
             return
 
-        # Обрабатываем каждую транзакцию
-        response = "✅ Добавлены транзакции:\n\n"
-        success_count = 0
-
-        for transaction in transactions:
-            transaction_type, category_text, amount = transaction
-
-            # Находим подходящую категорию
+        # Определяем категории и сохраняем все транзакции одной записью
+        categorized = []
+        for transaction_type, category_text, amount, note in transactions:
             category = db.find_category_by_keyword(user_id, category_text, transaction_type)
+            categorized.append((transaction_type, category, amount, note))
 
-            # Добавляем транзакцию
-            db.add_transaction(user_id, transaction_type, category, amount)
+        crossings = save_transactions(user_id, categorized)
+
+        response = "✅ Добавлены транзакции:\n\n"
+        success_count = 0
 
+        for transaction_type, category, amount, _ in categorized:
             # Добавляем информацию о транзакции в ответ
             type_emoji = "💸" if transaction_type == 'expense' else "💰"
             response += f"{type_emoji} *{category}*: {amount:.2f} ₽\n"
@@ -860,6 +2308,10 @@ def handle_message(message):
 
         if success_count > 0:
             response += f"\nВсего добавлено: {success_count} транзакций."
+            if text.count('\n') >= MAX_LINES_PER_MESSAGE:
+                response += f"\n\n⚠️ Обработаны только первые {MAX_LINES_PER_MESSAGE} строк."
+            for warning in format_budget_warnings(crossings):
+                response += f"\n\n{warning}"
             bot.send_message(user_id, response, parse_mode='Markdown')
         else:
             bot.send_message(
@@ -869,22 +2321,25 @@ def handle_message(message):
     else:
         # Обрабатываем одиночную транзакцию (существующий код)
         # Пробуем распарсить транзакцию
-        transaction_type, category_text, amount = parse_transaction_line(text)
+        transaction_type, category_text, amount, note = parse_transaction_line(text)
 
         if transaction_type and amount:
             # Находим подходящую категорию
             category = db.find_category_by_keyword(user_id, category_text, transaction_type)
 
             # Добавляем транзакцию
-            db.add_transaction(user_id, transaction_type, category, amount)
+            crossings = save_transactions(user_id, [(transaction_type, category, amount, note)])
 
             # Формируем ответное сообщение
             type_emoji = "💸" if transaction_type == 'expense' else "💰"
             response = f"{type_emoji} Добавлено: *{category}* {amount:.2f} ₽"
+            for warning in format_budget_warnings(crossings):
+                response += f"\n\n{warning}"
 
             bot.send_message(user_id, response, parse_mode='Markdown')
         else:
             # Если не распознали транзакцию
+            db.update_last_activity(user_id)
             bot.send_message(
                 user_id,
                 "❌ Не удалось распознать транзакцию. Используйте формат:\n"
@@ -895,7 +2350,18 @@ def handle_message(message):
             )
 
 
+# Обработчики шагов диалогов по имени шага (см. DatabaseManager.set_conversation_step)
+CONVERSATION_STEPS = {
+    'new_category': process_new_category,
+}
+
+
 if __name__ == "__main__":
+    # Перераспределение данных по шардам: python main.py reshard <количество>
+    if len(sys.argv) == 3 and sys.argv[1] == 'reshard':
+        db.reshard(int(sys.argv[2]))
+        sys.exit(0)
+
     # Запускаем планировщик в отдельном потоке
     scheduler_thread = threading.Thread(target=run_scheduler)
     scheduler_thread.daemon = True